@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import threading
+import time
 from flask import Flask, render_template, request
 from google.appengine.api import memcache, wrap_wsgi_app
 from google.appengine.ext import ndb
@@ -19,6 +22,15 @@ from google.appengine.ext import ndb
 app = Flask(__name__)
 app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
 HOUR = 3600
+LIMIT = 10
+CACHE_KEY = 'visits:v1'         # bump version if cached format changes
+LOCK_KEY = CACHE_KEY + ':lock'  # lease held by the one recomputing request
+FRESH = 30                      # secs cached visits are fresh (then stale)
+LEASE = 10                      # secs a recompute lease lasts at most
+WAIT = 0.5                      # secs a miss waits for another's recompute
+CAS_TRIES = 3                   # attempts to update cached visits via cas()
+STATS = collections.Counter()   # per-instance hit/stale/miss/recompute counts
+_stats_lock = threading.Lock()
 
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
@@ -27,24 +39,83 @@ class Visit(ndb.Model):
 
 def store_visit(remote_addr, user_agent):
     'create new Visit entity in Datastore'
-    Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
+    visit = Visit(visitor='{}: {}'.format(remote_addr, user_agent))
+    visit.put()
+    return visit
 
 def fetch_visits(limit):
     'get most recent visits'
     return Visit.query().order(-Visit.timestamp).fetch(limit)
 
+def _count(stat):
+    'bump per-instance cache statistic'
+    with _stats_lock:
+        STATS[stat] += 1
+
+def get_visits(limit):
+    'get (cached) most recent visits, recomputing at most once at a time'
+    # cached value is (fresh-until time, visits); serve it while fresh
+    client = memcache.Client()
+    entry = client.gets(CACHE_KEY)
+    if entry and entry[0] > time.time():
+        _count('hit')
+        return entry[1]
+
+    # stale or missing: only the request winning the lease hits Datastore;
+    # cas() fails (keeping newer data) if a visit was added meanwhile
+    if client.add(LOCK_KEY, 1, LEASE):
+        _count('recompute')
+        try:
+            visits = list(fetch_visits(limit))
+            value = (time.time() + FRESH, visits)
+            if entry:
+                client.cas(CACHE_KEY, value, HOUR)
+            else:
+                client.add(CACHE_KEY, value, HOUR)
+        finally:
+            client.delete(LOCK_KEY)
+        return visits
+
+    # someone else is recomputing: serve stale value while it does...
+    if entry:
+        _count('stale')
+        return entry[1]
+
+    # ...or briefly wait for it (if add() lost to a held lease rather than
+    # failing outright), then give up and query Datastore directly
+    _count('miss')
+    deadline = time.time() + WAIT if client.get(LOCK_KEY) else 0
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = client.get(CACHE_KEY)
+        if entry:
+            return entry[1]
+    return list(fetch_visits(limit))
+
+def cache_visit(visit, visits, limit):
+    'add new visit to cached visits (via compare-and-set) & return them'
+    client = memcache.Client()
+    for _ in range(CAS_TRIES):
+        entry = client.gets(CACHE_KEY)
+        if not entry:
+            break
+        fresh, cached = entry
+        updated = [visit] + cached[:limit-1]
+        if client.cas(CACHE_KEY, (fresh, updated), HOUR):
+            return updated
+    return [visit] + visits[:limit-1]
+
 @app.route('/')
 def root():
     'main application (GET) handler'
-    # check for (hour-)cached visits
+    # check for (cached) visits, independent of who is visiting
     ip_addr, usr_agt = request.remote_addr, request.user_agent
     visitor = '{}: {}'.format(ip_addr, usr_agt)
-    visits = memcache.get('visits')
+    visits = get_visits(LIMIT)
 
-    # register visit & run DB query if cache empty or new visitor
+    # register visit (& add to cache) if new visitor
     if not visits or visits[0].visitor != visitor:
-        store_visit(ip_addr, usr_agt)
-        visits = list(fetch_visits(10))
-        memcache.set('visits', visits, HOUR)  # set() not add()
+        visit = store_visit(ip_addr, usr_agt)
+        visits = cache_visit(visit, visits, LIMIT)
 
     return render_template('index.html', visits=visits)
@@ -12,8 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime, timedelta
+import collections
+import logging
 import os
 import pickle
+import struct
 from flask import Flask, render_template, request
 from google.cloud import ndb
 import redis
@@ -25,6 +29,12 @@ REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
 REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 REDIS = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
 
+# cached visits format: 'pickle' (default) or 'compact' (see README)
+VISITS_CODEC = os.environ.get('VISITS_CODEC', 'pickle')
+COMPACT_V1 = b'\x01'                # format version byte of 'compact' data
+VISIT_HDR = struct.Struct('>qH')    # per visit: epoch-micros, visitor length
+EPOCH = datetime(1970, 1, 1)
+
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
     visitor   = ndb.StringProperty()
@@ -40,6 +50,42 @@ def fetch_visits(limit):
     with ds_client.context():
         return Visit.query().order(-Visit.timestamp).fetch(limit)
 
+# lightweight (read-only) stand-in for Visit entities read back from Redis
+CachedVisit = collections.namedtuple('CachedVisit', 'visitor timestamp')
+
+def _micros(ts):
+    'naive UTC datetime as integer microseconds since the epoch'
+    delta = ts - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def dump_visits(visits):
+    'serialize visits for caching using VISITS_CODEC'
+    if VISITS_CODEC != 'compact':
+        return pickle.dumps(visits)
+    data = [COMPACT_V1]
+    for visit in visits:
+        visitor = visit.visitor.encode('utf-8')[:0xffff]
+        data.append(VISIT_HDR.pack(_micros(visit.timestamp), len(visitor)))
+        data.append(visitor)
+    return b''.join(data)
+
+def load_visits(data):
+    'deserialize cached visits (in either format); None if unreadable'
+    try:
+        if data[:1] != COMPACT_V1:
+            return pickle.loads(data)
+        visits, i = [], 1
+        while i < len(data):
+            micros, size = VISIT_HDR.unpack_from(data, i)
+            i += VISIT_HDR.size
+            visits.append(CachedVisit(data[i:i+size].decode('utf-8', 'replace'),
+                    EPOCH + timedelta(microseconds=micros)))
+            i += size
+        return visits
+    except Exception:
+        logging.warning('ignoring unreadable cached visits')
+        return None
+
 @app.route('/')
 def root():
     'main application (GET) handler'
@@ -47,12 +93,12 @@ def root():
     ip_addr, usr_agt = request.remote_addr, request.user_agent
     visitor = '{}: {}'.format(ip_addr, usr_agt)
     rsp = REDIS.get('visits')
-    visits = pickle.loads(rsp) if rsp else None
+    visits = load_visits(rsp) if rsp else None
 
     # register visit & run DB query if cache empty or new visitor
     if not visits or visits[0].visitor != visitor:
         store_visit(ip_addr, usr_agt)
         visits = list(fetch_visits(10))
-        REDIS.set('visits', pickle.dumps(visits), ex=HOUR)
+        REDIS.set('visits', dump_visits(visits), ex=HOUR)
 
     return render_template('index.html', visits=visits)
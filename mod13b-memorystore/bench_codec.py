@@ -0,0 +1,37 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare cached-visits payload size & encode/decode time of 'pickle' vs.
+'compact' formats. No Datastore or Redis calls are made, but Cloud NDB needs
+a project, e.g.: GOOGLE_CLOUD_PROJECT=test DATASTORE_EMULATOR_HOST=localhost:8081
+'''
+
+from datetime import datetime, timedelta
+import timeit
+import main
+
+N = 10000   # repetitions per timing
+
+with main.ds_client.context():
+    now = datetime.utcnow()
+    visits = [main.Visit(visitor='10.0.0.%d: Mozilla/5.0 (X11; Linux x86_64)' % i,
+            timestamp=now - timedelta(seconds=i)) for i in range(10)]
+    for codec in ('pickle', 'compact'):
+        main.VISITS_CODEC = codec
+        data = main.dump_visits(visits)
+        dump = timeit.timeit(lambda: main.dump_visits(visits), number=N)
+        load = timeit.timeit(lambda: main.load_visits(data), number=N)
+        print('%-8s %5d bytes  dump %6.1fus  load %6.1fus' % (
+                codec, len(data), dump / N * 1e6, load / N * 1e6))
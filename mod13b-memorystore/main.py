@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime, timedelta
+import atexit
+import collections
+import logging
 import os
 import pickle
-from flask import Flask, render_template, request
+import random
+import struct
+import threading
+import time
+from flask import Flask, jsonify, render_template, request
 from google.cloud import ndb
 import redis
 
@@ -22,37 +30,370 @@ app = Flask(__name__)
 ds_client = ndb.Client()
 HOUR = 3600
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
-REDIS_PORT = os.environ.get('REDIS_PORT', 6379)
-REDIS = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+REDIS_MAX_CONNS = int(os.environ.get('REDIS_MAX_CONNS', 10))  # per process
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', 0.5))   # secs
+REDIS_HEALTH = int(os.environ.get('REDIS_HEALTH', 30))  # secs between checks
+REDIS_TRIP = int(os.environ.get('REDIS_TRIP', 3))       # failures to trip...
+REDIS_RESET = float(os.environ.get('REDIS_RESET', 30))  # ...& secs to retry
+REDIS_POOL = redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT,
+        max_connections=REDIS_MAX_CONNS, timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT,
+        health_check_interval=REDIS_HEALTH)
+REDIS = redis.Redis(connection_pool=REDIS_POOL)
+
+# cached visits format: 'pickle' (default) or 'compact' (see README)
+VISITS_CODEC = os.environ.get('VISITS_CODEC', 'pickle')
+COMPACT_V1 = b'\x01'                # format version byte of 'compact' data
+VISIT_HDR = struct.Struct('>qH')    # per visit: epoch-micros, visitor length
+EPOCH = datetime(1970, 1, 1)
+
+# optional write-behind of Visits (off by default; see README)
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+WB_MAX_SIZE = int(os.environ.get('WB_MAX_SIZE', 1000))  # max buffered Visits
+WB_BATCH = int(os.environ.get('WB_BATCH', 100))         # flush this many...
+WB_MAX_AGE = float(os.environ.get('WB_MAX_AGE', 2.0))   # ...or after (secs)
+
+# optional materialized "recent visits" summary (off by default; see README)
+RECENT_VISITS = os.environ.get('RECENT_VISITS', '').lower() in ('1', 'true', 'yes')
+RV_SIZE = int(os.environ.get('RV_SIZE', 10))        # visits kept per shard
+RV_SHARDS = int(os.environ.get('RV_SHARDS', 1))     # summary entities
+RV_CHECK = float(os.environ.get('RV_CHECK', 0.01))  # share of reads verified
+
+# optional Redis-native visits ring (off by default; see README)
+REDIS_RING = os.environ.get('REDIS_RING', '').lower() in ('1', 'true', 'yes')
+RING_KEY = 'visits:ring'
+RING_SIZE = int(os.environ.get('RING_SIZE', 100))   # visits kept in Redis
+
+class CircuitBreaker(object):
+    'stop calling Redis after repeated failures, retrying after a while'
+    def __init__(self, trip, reset):
+        self.trip, self.reset = trip, reset
+        self.failures = 0       # consecutive failures
+        self.opened = None      # time.time() when breaker tripped (opened)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()  # calls/failures/skips/pool waits
+
+    def __call__(self, func, *args, **kwargs):
+        'call func (using Redis) unless breaker is open; None on failure'
+        with self.lock:
+            if self.opened and time.time() - self.opened < self.reset:
+                self.stats['skipped'] += 1
+                return None
+            self.stats['calls'] += 1
+        try:
+            result = func(*args, **kwargs)
+        except redis.RedisError as e:   # includes timeouts & exhausted pool
+            logging.warning('Redis call failed: %s', e)
+            with self.lock:
+                self.stats['failures'] += 1
+                if 'No connection available' in str(e):  # pool wait timed out
+                    self.stats['pool_timeouts'] += 1
+                self.failures += 1
+                if self.failures >= self.trip:
+                    self.opened = time.time()
+            return None
+        with self.lock:
+            self.failures, self.opened = 0, None
+        return result
+
+    @property
+    def healthy(self):
+        'whether Redis calls are currently being made'
+        return not self.opened or time.time() - self.opened >= self.reset
+
+WITH_REDIS = CircuitBreaker(REDIS_TRIP, REDIS_RESET)
+
+def redis_stats():
+    'Redis connection pool & circuit breaker metrics'
+    with WITH_REDIS.lock:
+        stats = dict(WITH_REDIS.stats)
+    # pool queue holds idle connections plus None for ones not yet created
+    created = len(REDIS_POOL._connections)
+    idle = sum(1 for conn in list(REDIS_POOL.pool.queue) if conn is not None)
+    stats.update(max_connections=REDIS_MAX_CONNS, created=created,
+            idle=idle, in_use=created - idle, healthy=WITH_REDIS.healthy)
+    return stats
 
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
     visitor   = ndb.StringProperty()
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
 
+
+class RecentVisits(ndb.Model):
+    'summary entity (shard) holding its most recent visits, newest first'
+    visits = ndb.LocalStructuredProperty(Visit, repeated=True)
+
+def _rv_keys():
+    'keys of all recent-visits summary shards (call within context)'
+    return [ndb.Key(RecentVisits, 'shard%d' % i) for i in range(RV_SHARDS)]
+
+def _newest(visits, limit):
+    'drop duplicate visits and return the `limit` most recent'
+    uniq = {(v.visitor, v.timestamp): v for v in visits}
+    return sorted(uniq.values(), key=lambda v: v.timestamp, reverse=True)[:limit]
+
+@ndb.transactional()
+def _add_recent(visits):
+    'merge (already-written) visits into a random summary shard'
+    key = random.choice(_rv_keys())
+    recent = key.get() or RecentVisits(key=key)
+    recent.visits = _newest(visits + recent.visits, RV_SIZE)
+    recent.put()
+
+def record_recent(visits):
+    'best-effort update of recent-visits summary (call within context)'
+    try:
+        _add_recent(visits)
+    except Exception:
+        logging.exception('recent-visits summary update failed')
+
+def fetch_recent(limit):
+    'get most recent visits from summary shards (call within context)'
+    return _newest([v for recent in ndb.get_multi(_rv_keys()) if recent
+            for v in recent.visits], limit)
+
+@ndb.transactional(xg=True)
+def _reset_recent(visits):
+    'rebuild summary shards from query results, keeping any newer visits'
+    # (visits merged in since the query ran are newer than all its results)
+    keys = _rv_keys()
+    newer = [v for recent in ndb.get_multi(keys) if recent
+            for v in recent.visits if not visits or
+            v.timestamp > visits[0].timestamp]
+    ndb.put_multi([RecentVisits(key=key, visits=_newest(newer + visits,
+            RV_SIZE) if i == 0 else []) for i, key in enumerate(keys)])
+
+def check_recent(recent, query):
+    'compare summary to query results & rebuild summary if they differ'
+    # visits newer than the summary's newest may just not be merged in yet
+    visits = [v for v in query if not recent or
+            v.timestamp <= recent[0].timestamp]
+    if [(v.visitor, v.timestamp) for v in recent[:len(visits)]] != [
+            (v.visitor, v.timestamp) for v in visits]:
+        logging.warning('recent-visits summary stale; rebuilding from query')
+        try:
+            _reset_recent(query)
+        except Exception:
+            logging.exception('recent-visits summary rebuild failed')
+
+
+class VisitBuffer(object):
+    'bounded in-process buffer writing Visits to Datastore in batches'
+    def __init__(self, max_size, batch, max_age):
+        self.max_size, self.batch, self.max_age = max_size, batch, max_age
+        self.visits = []        # pending Visits, oldest first
+        self.oldest = None      # time.time() when oldest pending Visit arrived
+        self.dropped = 0        # Visits lost to a full buffer or failed flush
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def pending(self):
+        'number of Visits buffered but not yet written'
+        return len(self.visits)
+
+    def add(self, visit):
+        'buffer Visit for writing; drop (and count) it if buffer is full'
+        with self.cond:
+            if self.closed or len(self.visits) >= self.max_size:
+                self.dropped += 1
+                return False
+            if not self.visits:
+                self.oldest = time.time()
+            self.visits.append(visit)
+            if len(self.visits) >= self.batch:
+                self.cond.notify()
+        return True
+
+    def recent(self):
+        'pending (not yet written) Visits, most recent first'
+        with self.cond:
+            return self.visits[::-1]
+
+    def close(self, timeout=10):
+        'stop accepting Visits and drain buffer (called at shutdown)'
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join(timeout)
+
+    def _due(self):
+        'whether a flush is due (call with lock held)'
+        return self.closed or len(self.visits) >= self.batch or (
+                self.visits and time.time() - self.oldest >= self.max_age)
+
+    def _run(self):
+        'flusher thread: write a batch when big enough or old enough'
+        while True:
+            with self.cond:
+                while not self._due():
+                    self.cond.wait(self.max_age if not self.visits else
+                            max(0, self.oldest + self.max_age - time.time()))
+                if self.closed and not self.visits:
+                    return
+                batch = self.visits[:self.batch]
+                self.visits = self.visits[self.batch:]
+                self.oldest = time.time() if self.visits else None
+            if not self._write(batch) and not self.closed:
+                time.sleep(self.max_age)    # back off before retrying
+
+    def _write(self, batch):
+        'put_multi() batch of Visits, re-queuing what fits on failure'
+        try:
+            with ds_client.context():
+                ndb.put_multi(batch)
+                if RECENT_VISITS:
+                    record_recent(batch)
+            return True
+        except Exception:
+            logging.exception('write-behind of %d Visit(s) failed', len(batch))
+        with self.cond:
+            kept = [] if self.closed else batch[:self.max_size-len(self.visits)]
+            self.visits[:0] = kept
+            if kept and self.oldest is None:
+                self.oldest = time.time()
+            self.dropped += len(batch) - len(kept)
+        return False
+
+VISITS = VisitBuffer(WB_MAX_SIZE, WB_BATCH, WB_MAX_AGE) if (
+        WRITE_BEHIND or REDIS_RING) else None
+
+
+# lightweight (read-only) stand-in for Visit entities read back from Redis
+CachedVisit = collections.namedtuple('CachedVisit', 'visitor timestamp')
+
+def _micros(ts):
+    'naive UTC datetime as integer microseconds since the epoch'
+    delta = ts - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def dump_visits(visits):
+    'serialize visits for caching using VISITS_CODEC'
+    if VISITS_CODEC != 'compact':
+        return pickle.dumps(visits)
+    data = [COMPACT_V1]
+    for visit in visits:
+        visitor = visit.visitor.encode('utf-8')[:0xffff]
+        data.append(VISIT_HDR.pack(_micros(visit.timestamp), len(visitor)))
+        data.append(visitor)
+    return b''.join(data)
+
+def load_visits(data):
+    'deserialize cached visits (in either format); None if unreadable'
+    try:
+        if data[:1] != COMPACT_V1:
+            return pickle.loads(data)
+        visits, i = [], 1
+        while i < len(data):
+            micros, size = VISIT_HDR.unpack_from(data, i)
+            i += VISIT_HDR.size
+            visits.append(CachedVisit(data[i:i+size].decode('utf-8', 'replace'),
+                    EPOCH + timedelta(microseconds=micros)))
+            i += size
+        return visits
+    except Exception:
+        logging.warning('ignoring unreadable cached visits')
+        return None
+
+def _ring_record(visit):
+    'compact Redis record for visit: "<epoch-micros> <visitor>"'
+    return '{} {}'.format(_micros(visit.timestamp), visit.visitor).encode('utf-8')
+
+def _ring_visit(record):
+    'CachedVisit from compact Redis record'
+    micros, visitor = record.decode('utf-8').split(' ', 1)
+    return CachedVisit(visitor, EPOCH + timedelta(microseconds=int(micros)))
+
+def push_ring(visit):
+    'push visit onto Redis ring & trim it to RING_SIZE (one round-trip)'
+    pipe = REDIS.pipeline()
+    pipe.lpush(RING_KEY, _ring_record(visit))
+    pipe.ltrim(RING_KEY, 0, RING_SIZE-1)
+    pipe.execute()
+
+def fetch_ring(limit):
+    'get most recent visits from Redis ring'
+    return [_ring_visit(r) for r in REDIS.lrange(RING_KEY, 0, limit-1)]
+
+def seed_ring(visits):
+    'merge (Datastore) visits into Redis ring & return merged visits'
+    def merge(pipe):
+        ring = [_ring_visit(r) for r in pipe.lrange(RING_KEY, 0, -1)]
+        merged = _newest(ring + list(visits), RING_SIZE)
+        pipe.multi()
+        pipe.delete(RING_KEY)
+        if merged:
+            pipe.rpush(RING_KEY, *[_ring_record(v) for v in merged])
+        return merged
+    return REDIS.transaction(merge, RING_KEY, value_from_callable=True)
+
 def store_visit(remote_addr, user_agent):
-    'create new Visit entity in Datastore'
+    'create new Visit entity in Datastore (or buffer it for write-behind)'
+    visitor = '{}: {}'.format(remote_addr, user_agent)
+    if VISITS:
+        visit = Visit(visitor=visitor, timestamp=datetime.utcnow())
+        if REDIS_RING:
+            WITH_REDIS(push_ring, visit)
+        VISITS.add(visit)
+        return
     with ds_client.context():
-        Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
+        visit = Visit(visitor=visitor)
+        visit.put()
+        if RECENT_VISITS:
+            record_recent([visit])
 
 def fetch_visits(limit):
-    'get most recent visits'
+    'get most recent visits (including any not yet written)'
+    # Redis ring answers alone unless it is short (just enabled or flushed)
+    if REDIS_RING:
+        visits = WITH_REDIS(fetch_ring, limit) or []
+        if len(visits) >= limit:
+            return visits
     with ds_client.context():
-        return Visit.query().order(-Visit.timestamp).fetch(limit)
+        visits = fetch_recent(limit) if RECENT_VISITS else []
+        # fall back to (and sometimes verify against) the ordered query
+        check = RECENT_VISITS and random.random() < RV_CHECK
+        if len(visits) < limit or check:
+            recent = visits
+            visits = Visit.query().order(-Visit.timestamp).fetch(limit)
+            if check:   # (a short summary is just still filling up)
+                check_recent(recent, visits)
+    merged = WITH_REDIS(seed_ring, visits) if REDIS_RING else None
+    if merged is not None:
+        return merged[:limit]
+    if VISITS:
+        visits = (VISITS.recent() + visits)[:limit]
+    return visits
+
+@app.route('/stats')
+def stats():
+    'Redis connection pool & circuit breaker metrics (JSON)'
+    return jsonify(redis_stats())
 
 @app.route('/')
 def root():
     'main application (GET) handler'
-    # check for (hour-)cached visits
+    # Redis ring holds recent visits itself, so no (pickled) cache needed
     ip_addr, usr_agt = request.remote_addr, request.user_agent
+    if REDIS_RING:
+        store_visit(ip_addr, usr_agt)
+        return render_template('index.html', visits=fetch_visits(10))
+
+    # check for (hour-)cached visits
     visitor = '{}: {}'.format(ip_addr, usr_agt)
-    rsp = REDIS.get('visits')
-    visits = pickle.loads(rsp) if rsp else None
+    rsp = WITH_REDIS(REDIS.get, 'visits')
+    visits = load_visits(rsp) if rsp else None
 
     # register visit & run DB query if cache empty or new visitor
     if not visits or visits[0].visitor != visitor:
         store_visit(ip_addr, usr_agt)
         visits = list(fetch_visits(10))
-        REDIS.set('visits', pickle.dumps(visits), ex=HOUR)
+        WITH_REDIS(REDIS.set, 'visits', dump_visits(visits), ex=HOUR)
 
     return render_template('index.html', visits=visits)
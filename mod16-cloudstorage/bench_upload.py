@@ -0,0 +1,69 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare upload time & peak memory of spooled (default), streamed, and
+parallel composite uploads for files of 100 KB to 1 GB. Run against a local
+fake GCS server, e.g. (Python 3): docker run -p 4443:4443
+fsouza/fake-gcs-server -scheme http -public-host localhost:4443, then
+STORAGE_EMULATOR_HOST=http://localhost:4443 GOOGLE_CLOUD_PROJECT=test
+python bench_upload.py (the 'test.appspot.com' bucket is created).
+'''
+
+import os
+import tempfile
+import time
+import tracemalloc
+import main
+
+PIECE = 64 * 1024   # bytes Werkzeug hands over per write
+SIZES = (100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3)
+DATA = os.urandom(PIECE)
+
+def spooled(fname, size):
+    'what Werkzeug & upload_from_file() do by default'
+    spool = tempfile.SpooledTemporaryFile(500 * 1024)
+    for _ in range(size // PIECE + 1):
+        spool.write(DATA)
+    spool.seek(0)
+    main.gcs_client.bucket(main.BUCKET).blob(fname).upload_from_file(
+            spool, size=size, content_type=main.OCTETS)
+
+def streamed(fname, size, composite=False):
+    upload = main.GCSUpload(fname, main.OCTETS, composite)
+    for _ in range(size // PIECE):
+        upload.write(DATA)
+    upload.write(DATA[:size % PIECE])
+    upload.finish()
+
+def parallel(fname, size):
+    streamed(fname, size, composite=True)
+
+bucket = main.gcs_client.bucket(main.BUCKET)
+if not bucket.exists():
+    bucket.create()
+for size in SIZES:
+    for upload in (spooled, streamed, parallel):
+        fname = 'bench-%s-%d' % (upload.__name__, size)
+        tracemalloc.start()
+        start = time.time()
+        upload(fname, size)
+        secs = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert bucket.get_blob(fname).size == size
+        bucket.delete_blob(fname)
+        print('%7d KB %-8s %7.2fs %8.1f MB/s  peak memory %6.1f MB' % (
+                size // 1024, upload.__name__, secs, size / secs / 1024 ** 2,
+                peak / 1024.0 ** 2))
@@ -12,20 +12,65 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import timedelta
+import hashlib
 import io
+import logging
+import os
+import threading
+import time
+import uuid
 
-from flask import (Flask, abort, redirect, render_template,
-        request, send_file, url_for)
+from flask import (Flask, Request, Response, abort, get_template_attribute,
+        redirect, render_template, request, url_for)
+from markupsafe import Markup
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
 
 import google.auth
-from google.cloud import exceptions, ndb, storage
+from google.auth.credentials import Signing
+from google.auth.transport import requests as google_requests
+from google.cloud import ndb, storage
+try:    # Blobstore API only available on App Engine (for backfill)
+    from google.appengine.ext import blobstore
+except ImportError:
+    blobstore = None
 
 app = Flask(__name__)
 ds_client = ndb.Client()
 gcs_client = storage.Client()
 _, PROJECT_ID = google.auth.default()
 BUCKET = '%s.appspot.com' % PROJECT_ID
+CHUNK = 256 * 1024  # max bytes of a download held in memory at once
+OCTETS = 'application/octet-stream'
+REVALIDATE = 'no-cache'     # browsers keep files but check ETag each view...
+IMMUTABLE = 'public, max-age=31536000, immutable'   # ...unless ?generation=
+
+# optional redirects to signed URLs (off by default; see README)
+SIGNED = os.environ.get('SIGNED_URLS', '').lower() in ('1', 'true', 'yes')
+SIGNED_TTL = 900    # secs signed URLs are valid for...
+SIGNED_SLACK = 60   # ...less secs before expiry they stop being reused
+SIGNED_CACHE = 1000 # max signed URLs cached
+GCS_ENDPOINT = os.environ.get('STORAGE_EMULATOR_HOST')  # e.g., local fake GCS
+_signed = {}
+_signed_lock = threading.Lock()
+
+# optional uploads streamed straight to Cloud Storage (off by default)
+STREAM_UPLOADS = os.environ.get('STREAM_UPLOADS', '').lower() in ('1', 'true', 'yes')
+UPLOAD_CHUNK = 1024 * 1024 * int(os.environ.get('UPLOAD_CHUNK_MB', 8))
+PARALLEL_UPLOADS = STREAM_UPLOADS and os.environ.get(
+        'PARALLEL_UPLOADS', '').lower() in ('1', 'true', 'yes')
+PARALLEL = 4                    # parts uploaded at once...
+COMPOSITE_MIN = 8 * UPLOAD_CHUNK    # ...for requests at least this big
+COMPOSE_MAX = 32                # GCS limit of objects composed per request
+
+# Blobstore-to-Cloud Storage backfill (see README)
+BACKFILL_PAGE = 100     # Visits read (& rewritten) per batch
+BACKFILL_THREADS = 8    # files copied at once
+BACKFILL_SECS = 50      # max secs per /backfill request; then checkpoint
+BACKFILL_SOURCE = os.environ.get('BACKFILL_SOURCE')  # bucket, not Blobstore
+ROWS_CACHE = 1000       # max pre-rendered visit rows cached
+_rows = {}
 
 
 
@@ -35,13 +80,42 @@ class Visit(ndb.Model):
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
     file_blob = ndb.BlobKeyProperty()  # backwards-compatibility
     file_gcs  = ndb.StringProperty()
+    file_ref  = ndb.StringProperty(indexed=False)   # either, for rendering
+    file_gen  = ndb.IntegerProperty(indexed=False)  # GCS generation, if known
+
+    def _pre_put_hook(self):
+        self.file_ref = file_ref(self)
+
+
+class Backfill(ndb.Model):
+    'Backfill entity checkpoints Blobstore-to-Cloud Storage copying'
+    cursor  = ndb.StringProperty(indexed=False)
+    total   = ndb.IntegerProperty(indexed=False)
+    scanned = ndb.IntegerProperty(indexed=False, default=0)
+    copied  = ndb.IntegerProperty(indexed=False, default=0)
+    failed  = ndb.IntegerProperty(indexed=False, default=0)
+    secs    = ndb.FloatProperty(indexed=False, default=0.0)
+    done    = ndb.BooleanProperty(indexed=False, default=False)
+
+
+def blob_name(blob_key):
+    'BlobKey as string (Cloud NDB BlobKey has no public accessor for it)'
+    name = blob_key._blob_key
+    return name.decode() if isinstance(name, bytes) else name
+
+
+def file_ref(visit):
+    'Cloud Storage filename of visit, or its (older) Blobstore BlobKey'
+    if visit.file_gcs:
+        return visit.file_gcs
+    return blob_name(visit.file_blob) if visit.file_blob else None
 
 
-def store_visit(remote_addr, user_agent, upload_key):
+def store_visit(remote_addr, user_agent, upload_key, generation=None):
     'create new Visit entity in Datastore'
     with ds_client.context():
         Visit(visitor='{}: {}'.format(remote_addr, user_agent),
-                file_gcs=upload_key).put()
+                file_gcs=upload_key, file_gen=generation).put()
 
 
 def fetch_visits(limit):
@@ -50,36 +124,298 @@ def fetch_visits(limit):
         return Visit.query().order(-Visit.timestamp).fetch(limit)
 
 
+class GCSUpload(object):
+    'writable stream sending (form) file straight to Cloud Storage'
+    def __init__(self, fname, content_type, composite=False):
+        self.blob = gcs_client.bucket(BUCKET).blob(fname)
+        self.blob.content_type = content_type
+        if not composite:   # one resumable upload, UPLOAD_CHUNK at a time
+            self.writer = self.blob.open('wb', chunk_size=UPLOAD_CHUNK,
+                    content_type=content_type, checksum='md5')
+            return
+        # parallel composite upload: UPLOAD_CHUNK-sized parts, composed at end
+        self.writer = None
+        self.md5 = hashlib.md5()    # composite objects get no MD5 from GCS
+        self.part = io.BytesIO()
+        self.parts, self.threads, self.errors = [], [], []
+        self.slots = threading.BoundedSemaphore(PARALLEL)
+        self.prefix = '%s.%s.part' % (fname, uuid.uuid4().hex[:8])
+
+    def write(self, data):
+        if self.writer:
+            return self.writer.write(data)
+        self.md5.update(data)
+        self.part.write(data)
+        if self.part.tell() >= UPLOAD_CHUNK:
+            self._send_part()
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        'no-op: Werkzeug rewinds files after parsing, but nothing is reread'
+        return 0
+
+    def _send_part(self):
+        'upload current part in background (at most PARALLEL parts at once)'
+        part, self.part = self.part, io.BytesIO()
+        blob = self.blob.bucket.blob('%s%d' % (self.prefix, len(self.parts)))
+        self.parts.append(blob)
+        self.slots.acquire()
+        thread = threading.Thread(target=self._upload_part, args=(blob, part))
+        thread.start()
+        self.threads.append(thread)
+
+    def _upload_part(self, blob, part):
+        try:
+            part.seek(0)
+            blob.upload_from_file(part, checksum='md5')
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.slots.release()
+
+    def finish(self):
+        'complete upload, verifying checksums'
+        if self.writer:
+            self.writer.close()
+            self.blob.reload()  # (for its generation)
+            return self.blob
+        if self.part.tell() or not self.parts:
+            self._send_part()
+        for thread in self.threads:
+            thread.join()
+        try:
+            if self.errors:
+                raise self.errors[0]
+            self.blob.metadata = {'md5': self.md5.hexdigest()}
+            self.blob.compose(self.parts[:COMPOSE_MAX])
+            for i in range(COMPOSE_MAX, len(self.parts), COMPOSE_MAX - 1):
+                self.blob.compose([self.blob] + self.parts[i:i+COMPOSE_MAX-1])
+        finally:
+            self.close()
+        return self.blob
+
+    def close(self):
+        'delete any parts; upload is abandoned unless already finished'
+        if not self.writer and self.parts:
+            for thread in self.threads:
+                thread.join()
+            self.blob.bucket.delete_blobs(self.parts, on_error=lambda b: None)
+            self.parts = []
+
+
+class StreamingRequest(Request):
+    'request whose form files are written straight to Cloud Storage'
+    def _get_file_stream(self, total_content_length, content_type,
+            filename=None, content_length=None):
+        return GCSUpload(secure_filename(filename), content_type,
+                PARALLEL_UPLOADS and (total_content_length or 0) >= COMPOSITE_MIN)
+
+if STREAM_UPLOADS:
+    app.request_class = StreamingRequest
+
+
 @app.route('/upload', methods=['POST'])
 def upload():
     'Upload blob (POST) handler'
-    fname = None
+    fname = generation = None
     upload = request.files.get('file', None)
     if upload:
         fname = secure_filename(upload.filename)
-        blob = gcs_client.bucket(BUCKET).blob(fname)
-        blob.upload_from_file(upload, content_type=upload.content_type)
-    store_visit(request.remote_addr, request.user_agent, fname)
+        if isinstance(upload.stream, GCSUpload):    # already (mostly) sent
+            blob = upload.stream.finish()
+        else:
+            blob = gcs_client.bucket(BUCKET).blob(fname)
+            blob.upload_from_file(upload, content_type=upload.content_type)
+        generation = blob.generation    # pinned in /view links
+    store_visit(request.remote_addr, request.user_agent, fname, generation)
     return redirect(url_for('root'), code=307)
 
 
+def signed_url(fname, generation=None):
+    'get (cached) V4 signed URL for object fname (of given generation)'
+    now = time.time()
+    with _signed_lock:
+        url, expires = _signed.get((fname, generation), (None, 0))
+    if expires - SIGNED_SLACK > now:
+        return url
+    creds, kwargs = gcs_client._credentials, {}
+    if not isinstance(creds, Signing):  # no private key: sign via IAM API
+        if not creds.valid:
+            creds.refresh(google_requests.Request())
+        kwargs.update(service_account_email=creds.service_account_email,
+                access_token=creds.token)
+    if GCS_ENDPOINT:
+        kwargs['api_access_endpoint'] = GCS_ENDPOINT
+    url = gcs_client.bucket(BUCKET).blob(fname).generate_signed_url(
+            version='v4', expiration=timedelta(seconds=SIGNED_TTL),
+            method='GET', generation=generation, **kwargs)
+    with _signed_lock:
+        if len(_signed) >= SIGNED_CACHE:
+            _signed.clear()
+        _signed[(fname, generation)] = (url, now + SIGNED_TTL)
+    return url
+
+
+def stream_blob(blob, start, stop):
+    'yield bytes [start, stop) of blob, CHUNK bytes at a time'
+    # blob (from get_blob()) carries its generation, so every chunk comes
+    # from the same object version even if it's overwritten mid-download
+    for offset in range(start, stop, CHUNK):
+        yield blob.download_as_bytes(
+                start=offset, end=min(offset + CHUNK, stop) - 1)
+
+
 @app.route('/view/<path:fname>')
 def view(fname):
     'view uploaded blob (GET) handler'
-    blob = gcs_client.bucket(BUCKET).blob(fname)
-    try:
-        media = blob.download_as_bytes()
-    except exceptions.NotFound:
+    # names can be re-uploaded, but each generation's content is immutable,
+    # so links pinning one (?generation=) can be cached for good
+    generation = request.args.get('generation')
+    if generation is not None:
+        if not generation.isdigit():
+            abort(404)
+        generation = int(generation)
+    if SIGNED:  # browser downloads directly from Cloud Storage
+        return redirect(signed_url(fname, generation))
+    blob = gcs_client.bucket(BUCKET).get_blob(fname, generation=generation)
+    if not blob:    # (or that generation is gone)
         abort(404)
-    return send_file(io.BytesIO(media), mimetype=blob.content_type)
 
+    etag = str(blob.generation)
+    headers = {
+        'ETag': '"%s"' % etag,
+        'Last-Modified': http_date(blob.updated),
+        'Cache-Control': IMMUTABLE if generation else REVALIDATE,
+    }
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        not_modified = blob.updated.replace(tzinfo=None, microsecond=0) <= \
+                request.if_modified_since.replace(tzinfo=None)
+    else:
+        not_modified = False
+    if not_modified:    # client copy is current: skip download entirely
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, blob.size, 200
+    headers['Accept-Ranges'] = 'bytes'
+    if request.range and len(request.range.ranges) == 1 and blob.size:
+        byte_range = request.range.range_for_length(blob.size)
+        if not byte_range:
+            return Response(status=416, headers={
+                    'Content-Range': 'bytes */%d' % blob.size})
+        start, stop = byte_range
+        headers['Content-Range'] = request.range.to_content_range_header(
+                blob.size)
+        status = 206
+    headers['Content-Length'] = str(stop - start)
+    return Response(stream_blob(blob, start, stop), status=status,
+            headers=headers, mimetype=blob.content_type or OCTETS,
+            direct_passthrough=True)
+
+
+def render_rows(visits):
+    'get (cached) pre-rendered HTML rows of (immutable) visits'
+    try:
+        return Markup('').join([_rows[v.key.id()] for v in visits])
+    except KeyError:    # some visits not seen before: render & cache them
+        pass
+    if len(_rows) >= ROWS_CACHE:
+        _rows.clear()
+    row = get_template_attribute('row.html', 'row')
+    rows = []
+    for v in visits:
+        html = _rows.get(v.key.id())
+        if html is None:    # file_ref(v) for visits not yet swept
+            html = _rows[v.key.id()] = row(v.timestamp,
+                    v.file_ref or file_ref(v), v.visitor, v.file_gen)
+        rows.append(html)
+    return Markup('').join(rows)
+
+
+def copy_blob(name):
+    'copy Blobstore file to Cloud Storage, named by BlobKey like /view links'
+    try:    # return generation of copy (or None if failed)
+        if BACKFILL_SOURCE:     # e.g., exported files, or local fake GCS
+            source = gcs_client.bucket(BACKFILL_SOURCE)
+            blob = source.copy_blob(source.blob(name),
+                    gcs_client.bucket(BUCKET))
+        else:
+            info = blobstore.BlobInfo.get(name)
+            blob = gcs_client.bucket(BUCKET).blob(name)
+            blob.upload_from_file(blobstore.BlobReader(name),
+                    content_type=info.content_type, size=info.size)
+        return blob.generation
+    except Exception as e:
+        logging.warning('backfill: cannot copy %s: %s', name, e)
+        return None
+
+
+def copy_blobs(names):
+    'copy files with up to BACKFILL_THREADS threads; return their generations'
+    results = [None] * len(names)
+    todo = list(enumerate(names))
+    lock = threading.Lock()
+    def copier():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                i, name = todo.pop()
+            results[i] = copy_blob(name)
+    threads = [threading.Thread(target=copier)
+            for _ in range(min(BACKFILL_THREADS, len(names)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@app.route('/backfill')
+def backfill():
+    'copy legacy Blobstore files to Cloud Storage for BACKFILL_SECS at most'
+    if not (BACKFILL_SOURCE or blobstore):
+        return 'backfill: no Blobstore API here; set BACKFILL_SOURCE', 501
+    start = time.time()
+    with ds_client.context():
+        ckpt = Backfill.get_by_id('blobs')
+        if not ckpt or request.args.get('restart'):
+            ckpt = Backfill(id='blobs', total=Visit.query().count())
+        cursor = ndb.Cursor(urlsafe=ckpt.cursor) if ckpt.cursor else None
+        while not ckpt.done and time.time() - start < BACKFILL_SECS:
+            page_start = time.time()
+            visits, cursor, more = Visit.query().fetch_page(
+                    BACKFILL_PAGE, start_cursor=cursor)
+            todo = [v for v in visits if v.file_blob and not v.file_gcs]
+            copied = []
+            for visit, generation in zip(todo, copy_blobs(
+                    [blob_name(v.file_blob) for v in todo])):
+                if generation:
+                    visit.file_gcs = blob_name(visit.file_blob)
+                    visit.file_gen = generation
+                    copied.append(visit)
+            # also sweep in any visits from before file_ref was added
+            keys = set(v.key for v in copied)
+            ndb.put_multi(copied + [v for v in visits
+                    if v.key not in keys and v.file_ref != file_ref(v)])
+            ckpt.scanned += len(visits)
+            ckpt.copied += len(copied)
+            ckpt.failed += len(todo) - len(copied)
+            ckpt.cursor = cursor.urlsafe().decode() if more and cursor else None
+            ckpt.done = not ckpt.cursor
+            ckpt.secs += time.time() - page_start
+            ckpt.put()      # checkpoint: safe to stop (& resume) here
 
-def etl_visits(visits):
-    return [{
-            'visitor': v.visitor,
-            'timestamp': v.timestamp,
-            'file_blob': v.file_gcs if hasattr(v, 'file_gcs') and v.file_gcs else v.file_blob
-            } for v in visits]
+    rate = ckpt.scanned / ckpt.secs if ckpt.secs else 0.0
+    status = 'done' if ckpt.done else 'ETA %ds' % (
+            max(ckpt.total - ckpt.scanned, 0) / rate if rate else -1)
+    report = ('backfill: %d/%d visits scanned, %d files copied, %d failed; '
+            '%.1f visits/s, %.1f files/s; %s' % (ckpt.scanned, ckpt.total,
+            ckpt.copied, ckpt.failed, rate,
+            ckpt.copied / ckpt.secs if ckpt.secs else 0.0, status))
+    logging.info(report)
+    return report
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -89,5 +425,5 @@ def root():
     if request.method == 'GET':
         context['upload_url'] = url_for('upload')
     else:
-        context['visits'] = etl_visits(fetch_visits(10))
+        context['rows'] = render_rows(fetch_visits(10))
     return render_template('index.html', **context)
@@ -12,13 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+import logging
+import os
+import random
+import time
 from flask import Flask, render_template, request
-from google.appengine.api import taskqueue
+from google.appengine.api import runtime, taskqueue
 from google.appengine.ext import ndb
+from sketch import CountMin, SpaceSaving
 
 HOUR = 3600
 TASKS = 1000
+TX_SIZE = 25    # visitors (entity groups) per transaction
 LIMIT = 10
+LEASE = 60          # secs tasks are leased for in worker mode
+MIN_BATCH = 10      # worker lease batch size adapts between these
+MAX_BATCH = TASKS
+MAX_IDLE = 60       # max secs worker backs off when queue is empty
+REPORT = 60         # secs between worker throughput/lag reports
+
+# optional sharded visitor counts (off by default; see README)
+SHARDED = os.environ.get('SHARDED_COUNTS', '').lower() in ('1', 'true', 'yes')
+SHARDS = 4          # initial shards per visitor, doubling (up to MAX_SHARDS)
+MAX_SHARDS = 64     # for visitors with at least HOT_TALLY visits in a batch
+HOT_TALLY = 100
+HOT_SECS = 10       # min secs between refreshes of hot visitors' totals
+_refreshed = {}     # hot visitor: when (this process) last wrote its total
+_overdue = {}       # hot visitor: shard count, if its total still lags shards
+
+# optional precomputed leaderboard (off by default; see README)
+LEADERBOARD = os.environ.get('LEADERBOARD', '').lower() in ('1', 'true', 'yes')
+TOP_K = 100         # visitors kept on leaderboard
+UNINDEXED_COUNTS = LEADERBOARD and os.environ.get(
+        'UNINDEXED_COUNTS', '').lower() in ('1', 'true', 'yes')
+
+# optional approximate counting (off by default; see README)
+APPROX = os.environ.get('APPROX_COUNTS', '').lower() in ('1', 'true', 'yes')
+SKETCHES = 4        # sketch entities, merged on read
 QNAME = 'pullq'
 QUEUE = taskqueue.Queue(QNAME)
 app = Flask(__name__)
@@ -32,7 +63,8 @@ class Visit(ndb.Model):
 def store_visit(remote_addr, user_agent):
     'create new Visit in Datastore and queue request to bump visitor count'
     Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
-    QUEUE.add(taskqueue.Task(payload=remote_addr, method='PULL'))
+    QUEUE.add(taskqueue.Task(payload=remote_addr, method='PULL',
+            tag='%.3f' % time.time()))  # (enqueue time, for worker lag)
 
 def fetch_visits(limit):
     'get most recent visits'
@@ -40,38 +72,282 @@ def fetch_visits(limit):
 
 
 class VisitorCount(ndb.Model):
+    'VisitorCount entity (keyed by visitor) tallies visits per visitor'
     visitor = ndb.StringProperty(repeated=False, required=True)
-    counter = ndb.IntegerProperty()
+    counter = ndb.IntegerProperty(indexed=not UNINDEXED_COUNTS)
+
+@ndb.transactional(xg=True)
+def _add_counts(tallies):
+    'add tallies to (keyed-by-visitor) counts in a single transaction'
+    keys = [ndb.Key(VisitorCount, visitor) for visitor in tallies]
+    counts = []
+    for key, count in zip(keys, ndb.get_multi(keys)):
+        count = count or VisitorCount(key=key, visitor=key.id(), counter=0)
+        count.counter += tallies[key.id()]
+        counts.append(count)
+    ndb.put_multi(counts)
+    return {count.visitor: count.counter for count in counts}
+
+def update_counts(tallies):
+    'add tallies to visitor counts, TX_SIZE visitors per transaction'
+    if APPROX:
+        return update_approx_counts(tallies)
+    if SHARDED:
+        totals = update_sharded_counts(tallies)
+    else:
+        totals = {}
+        visitors = list(tallies)
+        for i in range(0, len(visitors), TX_SIZE):
+            totals.update(_add_counts(
+                    {v: tallies[v] for v in visitors[i:i+TX_SIZE]}))
+    if LEADERBOARD and totals:
+        update_board(totals)
+    return totals
+
+@ndb.transactional(xg=True)
+def _rekey_count(old_key):
+    'move legacy (auto-ID) count into its keyed-by-visitor entity'
+    old = old_key.get()
+    if old:
+        key = ndb.Key(VisitorCount, old.visitor)
+        count = key.get() or VisitorCount(key=key, visitor=old.visitor, counter=0)
+        count.counter += old.counter or 0
+        count.put()
+        old_key.delete()
+
+
+class VisitorCountShard(ndb.Model):
+    'partial visit count for a visitor; shard 0 also holds the shard count'
+    counter = ndb.IntegerProperty(indexed=False)
+    shards  = ndb.IntegerProperty(indexed=False)
+
+def _shard_key(visitor, shard):
+    'key of visitor count shard'
+    return ndb.Key(VisitorCountShard, '%s#%d' % (visitor, shard))
+
+@ndb.transactional(xg=True)
+def _set_shards(visitors, hot):
+    'start (w/any unsharded count) or grow (if hot) shard 0 of each visitor'
+    keys = [_shard_key(v, 0) for v in visitors]
+    firsts = ndb.get_multi(keys)
+    new = [v for v, first in zip(visitors, firsts) if not first]
+    counts = dict(zip(new, ndb.get_multi(
+            [ndb.Key(VisitorCount, v) for v in new])))
+    shards, changed = {}, []
+    for visitor, key, first in zip(visitors, keys, firsts):
+        if not first:   # start sharding, keeping any earlier count
+            count = counts[visitor]
+            first = VisitorCountShard(key=key, shards=SHARDS,
+                    counter=count.counter if count else 0)
+            changed.append(first)
+        elif visitor in hot and first.shards < MAX_SHARDS:
+            first.shards = min(first.shards * 2, MAX_SHARDS)
+            changed.append(first)
+        shards[visitor] = first.shards
+    ndb.put_multi(changed)
+    return shards
+
+@ndb.transactional(xg=True)
+def _add_shard_counts(tallies):
+    'add tallies to (keyed) visitor count shards in a single transaction'
+    shards = []
+    for key, shard in zip(tallies, ndb.get_multi(list(tallies))):
+        shard = shard or VisitorCountShard(key=key, counter=0)
+        shard.counter += tallies[key]
+        shards.append(shard)
+    ndb.put_multi(shards)
+
+def update_sharded_counts(tallies):
+    'add tallies to random visitor count shards, then refresh their totals'
+    # look up (or start, or grow for hot visitors) each visitor's shard count
+    visitors = list(tallies)
+    hot = set(v for v in visitors if tallies[v] >= HOT_TALLY)
+    shards, todo = {}, []
+    for visitor, first in zip(visitors,
+            ndb.get_multi([_shard_key(v, 0) for v in visitors])):
+        if first and not (visitor in hot and first.shards < MAX_SHARDS):
+            shards[visitor] = first.shards
+        else:
+            todo.append(visitor)
+    step = TX_SIZE // 2     # (2 entity groups per new visitor)
+    for i in range(0, len(todo), step):
+        shards.update(_set_shards(todo[i:i+step], hot))
+
+    # add tallies to a random shard each, TX_SIZE shards per transaction
+    incs = {_shard_key(v, random.randrange(shards[v])): tallies[v]
+            for v in visitors}
+    keys = list(incs)
+    for i in range(0, len(keys), TX_SIZE):
+        _add_shard_counts({k: incs[k] for k in keys[i:i+TX_SIZE]})
+
+    # cache sums of shards as VisitorCount totals (blind writes: no conflicts)
+    # but only every HOT_SECS (per process) for hot (grown) visitors, so their
+    # VisitorCount isn't rewritten by every batch of every worker; hot ones
+    # stay overdue until refreshed, by a later (even empty) batch if need be
+    now = time.time()
+    _overdue.update((v, shards[v]) for v in visitors if shards[v] > SHARDS)
+    due = {v: shards[v] for v in visitors if shards[v] <= SHARDS}
+    due.update((v, n) for v, n in list(_overdue.items())
+            if now - _refreshed.get(v, 0) >= HOT_SECS)
+    keys = [_shard_key(v, i) for v in due for i in range(due[v])]
+    totals = dict.fromkeys(due, 0)
+    for key, shard in zip(keys, ndb.get_multi(keys)):
+        totals[key.id().rsplit('#', 1)[0]] += shard.counter if shard else 0
+    ndb.put_multi([VisitorCount(key=ndb.Key(VisitorCount, v), visitor=v,
+            counter=n) for v, n in totals.items()])
+    for visitor in due:
+        if _overdue.pop(visitor, None):
+            _refreshed[visitor] = now
+    return totals
+
+
+class TopVisitors(ndb.Model):
+    'leaderboard entity holding the TOP_K visitor counts, highest first'
+    counts = ndb.LocalStructuredProperty(VisitorCount, repeated=True)
+
+def _board_key():
+    'key of (single) leaderboard entity'
+    return ndb.Key(TopVisitors, 'top')
+
+@ndb.transactional()
+def update_board(totals):
+    'merge (new) visitor totals into leaderboard, keeping the TOP_K'
+    # counts only grow, so keep the larger of board & batch total (batches
+    # may merge out of order), & visitors not in this batch keep their places
+    board = _board_key().get() or TopVisitors(key=_board_key())
+    merged = {count.visitor: count.counter for count in board.counts}
+    for visitor, counter in totals.items():
+        merged[visitor] = max(merged.get(visitor, 0), counter)
+    board.counts = [VisitorCount(visitor=visitor, counter=counter)
+            for visitor, counter in heapq.nlargest(
+                TOP_K, merged.items(), key=lambda item: item[1])]
+    board.put()
+
+
+class VisitorSketch(ndb.Model):
+    'approximate visitor counts: Count-Min & Space-Saving blobs, mergeable'
+    sketch = ndb.BlobProperty()
+    heavy = ndb.BlobProperty()
+
+@ndb.transactional()
+def _add_sketch(key, tallies):
+    'add tallies to one sketch entity'
+    entity = key.get() or VisitorSketch(key=key)
+    cms = CountMin.loads(entity.sketch) if entity.sketch else CountMin()
+    ssv = SpaceSaving.loads(entity.heavy) if entity.heavy else SpaceSaving()
+    for visitor, tally in tallies.items():
+        cms.add(visitor, tally)
+        ssv.add(visitor, tally)
+    entity.sketch, entity.heavy = cms.dumps(), ssv.dumps()
+    entity.put()
+
+def update_approx_counts(tallies):
+    'add tallies to a random sketch entity (spreads concurrent workers)'
+    if not tallies:     # (empty lease/pull: skip rewriting a whole sketch)
+        return {}
+    _add_sketch(ndb.Key(VisitorSketch, 'sketch%d' % random.randrange(
+            SKETCHES)), tallies)
+    return {}
+
+def fetch_approx_counts(limit):
+    'merge sketch entities, get top visitors with tightest estimates'
+    cms, ssv = CountMin(), SpaceSaving()
+    for entity in ndb.get_multi([ndb.Key(VisitorSketch, 'sketch%d' % i)
+            for i in range(SKETCHES)]):
+        if entity:
+            cms.merge(CountMin.loads(entity.sketch))
+            ssv.merge(SpaceSaving.loads(entity.heavy))
+    # both overestimate, so the smaller is closer
+    counts = [VisitorCount(visitor=visitor, counter=min(count,
+            cms.estimate(visitor))) for visitor, count, error in ssv.top(limit)]
+    return sorted(counts, key=lambda count: -count.counter)
 
 def fetch_counts(limit):
     'get top visitors'
-    return VisitorCount.query().order(-VisitorCount.counter).fetch(limit)
+    if APPROX:
+        return fetch_approx_counts(limit)
+    if not LEADERBOARD:
+        return VisitorCount.query().order(-VisitorCount.counter).fetch(limit)
+    board = _board_key().get()  # (seeded by /migrate)
+    return board.counts[:limit] if board else []
 
 
-@app.route('/log')
-def log_visitors():
-    'worker processes recent visitor counts and updates them in Datastore'
-    # tally recent visitor counts from queue then delete those tasks
+def process_tasks(lease, max_tasks):
+    'lease tasks, commit their visitor counts, then delete tasks'
+    # tally recent visitor counts from queue
     tallies = {}
-    tasks = QUEUE.lease_tasks(HOUR, TASKS)
+    tasks = QUEUE.lease_tasks(lease, max_tasks)
     for task in tasks:
         visitor = task.payload
         tallies[visitor] = tallies.get(visitor, 0) + 1
+
+    # increment those counts in Datastore, and only then delete those tasks
+    # (if anything fails, leases expire and tasks are processed again)
+    update_counts(tallies)
     if tasks:
         QUEUE.delete_tasks(tasks)
+    return tasks, tallies
 
-    # increment those counts in Datastore and return
-    for visitor in tallies:
-        counter = VisitorCount.query(VisitorCount.visitor == visitor).get()
-        if not counter:
-            counter = VisitorCount(visitor=visitor, counter=0)
-            counter.put()
-        counter.counter += tallies[visitor]
-        counter.put()
+
+@app.route('/log')
+def log_visitors():
+    'worker processes recent visitor counts and updates them in Datastore'
+    tasks, tallies = process_tasks(HOUR, TASKS)
     return 'DONE (with %d task[s] logging %d visitor[s])\r\n' % (
             len(tasks), len(tallies))
 
 
+@app.route('/_ah/start')
+def work():
+    'long-running worker (manual scaling) continuously processing tasks'
+    batch, idle = MIN_BATCH, 1
+    ntasks, lag, since = 0, 0, time.time()
+    while not runtime.is_shutting_down():
+        try:
+            tasks, _ = process_tasks(LEASE, batch)
+        except Exception:   # leased tasks are retried once leases expire
+            logging.exception('Worker: batch failed')
+            tasks = []
+        if tasks:
+            # grow batch size while leases come back full, else shrink it
+            batch = min(batch * 2, MAX_BATCH) if len(tasks) == batch else max(
+                    batch // 2, MIN_BATCH)
+            ntasks += len(tasks)
+            # (leased tasks' ETAs are lease expiries, so use enqueue times)
+            queued = [float(task.tag) for task in tasks if task.tag]
+            if queued:
+                lag = time.time() - min(queued)
+            idle = 1
+        else:
+            # queue empty: back off (exponentially) before leasing again
+            time.sleep(idle)
+            idle = min(idle * 2, MAX_IDLE)
+
+        # report throughput & lag (age of oldest task in latest batch)
+        elapsed = time.time() - since
+        if elapsed >= REPORT:
+            logging.info('Worker: %.1f tasks/sec, lag %.1f secs, batch %d' % (
+                    ntasks / elapsed, lag, batch))
+            ntasks, since = 0, time.time()
+    return ''   # need to return SOME string w/200
+
+
+@app.route('/migrate')
+def migrate_counts():
+    'one-time re-keying of (up to TASKS) legacy auto-ID VisitorCounts'
+    if LEADERBOARD and not _board_key().get():  # seed from all visitor counts
+        update_board({count.visitor: count.counter
+                for count in VisitorCount.query()})
+    moved = 0
+    for key in VisitorCount.query().iter(keys_only=True):
+        if key.integer_id() is not None:
+            _rekey_count(key)
+            moved += 1
+            if moved >= TASKS:
+                break
+    return 'DONE (re-keyed %d visitor count[s])\r\n' % moved
+
+
 @app.route('/')
 def root():
     'main application (GET) handler'
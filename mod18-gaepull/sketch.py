@@ -0,0 +1,114 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Mergeable approximate counters: Count-Min sketch (per-item estimates) and
+Space-Saving (top-K heavy hitters), both serializable to compact blobs.
+'''
+
+import hashlib
+import heapq
+import json
+import struct
+import zlib
+
+CM_WIDTH = 2048     # counters per row: error <= 2/CM_WIDTH * total (whp)
+CM_DEPTH = 4        # rows (at most 4, one per 32-bit word of an MD5 digest)
+SS_SIZE = 200       # items tracked by Space-Saving (2x TOP_K)
+
+
+class CountMin(object):
+    'Count-Min sketch: never underestimates, overestimates by a bounded amount'
+    def __init__(self, width=CM_WIDTH, depth=CM_DEPTH, table=None):
+        self.width, self.depth = width, depth
+        self.table = table or [0] * (width * depth)
+
+    def _cells(self, item):
+        words = struct.unpack('>4I', hashlib.md5(item.encode('utf-8')).digest())
+        return [row * self.width + words[row] % self.width
+                for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        for cell in self._cells(item):
+            self.table[cell] += count
+
+    def estimate(self, item):
+        return min(self.table[cell] for cell in self._cells(item))
+
+    def merge(self, other):
+        'add counts of same-shaped sketch'
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('cannot merge differently-sized sketches')
+        self.table = [a + b for a, b in zip(self.table, other.table)]
+        return self
+
+    def dumps(self):
+        return zlib.compress(struct.pack('>HH%dQ' % len(self.table),
+                self.width, self.depth, *self.table))
+
+    @classmethod
+    def loads(cls, data):
+        data = zlib.decompress(data)
+        width, depth = struct.unpack_from('>HH', data)
+        return cls(width, depth,
+                list(struct.unpack_from('>%dQ' % (width * depth), data, 4)))
+
+
+class SpaceSaving(object):
+    'Space-Saving summary: {item: [count, error]} of the heaviest items'
+    def __init__(self, size=SS_SIZE, counts=None):
+        self.size = size
+        self.counts = counts or {}
+
+    def _floor(self):
+        'count any untracked item may have had (0 until summary is full)'
+        if len(self.counts) < self.size:
+            return 0
+        return min(count for count, error in self.counts.values())
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item][0] += count
+        elif len(self.counts) < self.size:
+            self.counts[item] = [count, 0]
+        else:   # replace smallest item, inheriting its count as error
+            victim = min(self.counts, key=lambda i: self.counts[i][0])
+            floor = self.counts.pop(victim)[0]
+            self.counts[item] = [floor + count, floor]
+
+    def merge(self, other):
+        'combine two summaries (Agarwal et al., "Mergeable Summaries")'
+        mine, theirs = self._floor(), other._floor()
+        merged = {}
+        for item in set(self.counts) | set(other.counts):
+            count, error = self.counts.get(item, (mine, mine))
+            count2, error2 = other.counts.get(item, (theirs, theirs))
+            merged[item] = [count + count2, error + error2]
+        self.counts = dict(heapq.nlargest(self.size, merged.items(),
+                key=lambda item: item[1][0]))
+        return self
+
+    def top(self, k):
+        'k heaviest (item, count, error) tuples, heaviest first'
+        return [(item, count, error) for item, (count, error) in heapq.nlargest(
+                k, self.counts.items(), key=lambda item: item[1][0])]
+
+    def dumps(self):
+        return zlib.compress(json.dumps([self.size, self.counts],
+                separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def loads(cls, data):
+        size, counts = json.loads(zlib.decompress(data).decode('utf-8'))
+        return cls(size, counts)
@@ -0,0 +1,69 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare approximate (sketch) vs. exact visitor counting on synthetic Zipfian
+traffic: storage footprint, top-K recall, and count error. Visits are split
+across WORKERS whose sketches are merged, as with SKETCHES entities. No
+Datastore calls are made.
+'''
+
+from __future__ import print_function
+import bisect
+import collections
+import random
+from sketch import CountMin, SpaceSaving
+
+VISITS = 300000
+WORKERS = 4
+TOP_K = 10
+ENTITY = 100    # rough bytes per exact VisitorCount entity (plus indexes)
+
+def zipf(visitors, skew):
+    'generator of visitor names drawn from Zipf distribution'
+    total, cumul = 0.0, []
+    for rank in range(1, visitors + 1):
+        total += 1.0 / rank ** skew
+        cumul.append(total)
+    while True:
+        yield '10.%d.%d.%d' % ((bisect.bisect(cumul, random.random() * total),
+                ) * 3)
+
+for visitors, skew in ((10000, 1.1), (100000, 1.1), (100000, 0.8)):
+    random.seed(0)
+    exact = collections.Counter()
+    sketches = [(CountMin(), SpaceSaving()) for _ in range(WORKERS)]
+    traffic = zipf(visitors, skew)
+    for i in range(VISITS):
+        visitor = next(traffic)
+        exact[visitor] += 1
+        cms, ssv = sketches[i % WORKERS]
+        cms.add(visitor)
+        ssv.add(visitor)
+    cms, ssv = sketches[0]
+    for other_cms, other_ssv in sketches[1:]:
+        cms.merge(other_cms)
+        ssv.merge(other_ssv)
+
+    true_top = [visitor for visitor, count in exact.most_common(TOP_K)]
+    approx = [(visitor, min(count, cms.estimate(visitor)))
+            for visitor, count, error in ssv.top(TOP_K)]
+    recall = len(set(true_top) & set(v for v, c in approx)) / float(TOP_K)
+    error = max(abs(count - exact[visitor]) / float(exact[visitor])
+            for visitor, count in approx)
+    print('%6d visitors, skew %.1f: exact %5d KB (%d entities), '
+            'sketch %4d KB; top-%d recall %3d%%, max error %.2f%%' % (
+            visitors, skew, len(exact) * ENTITY // 1024, len(exact),
+            (len(cms.dumps()) + len(ssv.dumps())) * WORKERS // 1024, TOP_K,
+            recall * 100, error * 100))
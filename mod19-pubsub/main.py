@@ -12,18 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import collections
+import heapq
+import logging
+import os
+import random
+import sys
+import threading
+import time
 from flask import Flask, render_template, request
 import google.auth
 from google.cloud import ndb, pubsub
+from sketch import CountMin, SpaceSaving
 
 TASKS = 1000
+TX_SIZE = 25    # visitors (entity groups) per transaction
 LIMIT = 10
 TOPIC = 'pullq'
 SBSCR = 'worker'
+PY3 = sys.version_info[0] >= 3  # python27 joins request threads; see README
+
+# optional streaming-pull subscriber (off by default, Python 3 only; see README)
+STREAMING = PY3 and os.environ.get(
+        'STREAMING_PULL', '').lower() in ('1', 'true', 'yes')
+FLUSH_SECS = 5          # secs between streamed tally flushes...
+FLUSH_MSGS = TASKS      # ...or flush as soon as this many messages pending
+FLOW_MSGS = 2 * TASKS   # max messages outstanding (not yet acked)
+
+# optional sharded visitor counts (off by default; see README)
+SHARDED = os.environ.get('SHARDED_COUNTS', '').lower() in ('1', 'true', 'yes')
+SHARDS = 4          # initial shards per visitor, doubling (up to MAX_SHARDS)
+MAX_SHARDS = 64     # for visitors with at least HOT_TALLY visits in a batch
+HOT_TALLY = 100
+HOT_SECS = 10       # min secs between refreshes of hot visitors' totals
+_refreshed = {}     # hot visitor: when (this process) last wrote its total
+_overdue = {}       # hot visitor: shard count, if its total still lags shards
+
+# optional precomputed leaderboard (off by default; see README)
+LEADERBOARD = os.environ.get('LEADERBOARD', '').lower() in ('1', 'true', 'yes')
+TOP_K = 100         # visitors kept on leaderboard
+UNINDEXED_COUNTS = LEADERBOARD and os.environ.get(
+        'UNINDEXED_COUNTS', '').lower() in ('1', 'true', 'yes')
+
+# optional approximate counting (off by default; see README)
+APPROX = os.environ.get('APPROX_COUNTS', '').lower() in ('1', 'true', 'yes')
+SKETCHES = 4        # sketch entities, merged on read
+
+# publisher batching & (optional) per-visitor aggregation; see README
+PUB_BATCH = pubsub.types.BatchSettings(
+        max_messages=100, max_bytes=1024*1024, max_latency=0.05)
+PUB_FLOW_MSGS = 10 * TASKS  # max messages being published at once
+AGGREGATE_SECS = float(os.environ.get('AGGREGATE_SECS', 0)) if PY3 else 0
+PUB_STATS = collections.Counter()   # published/failed message counts
+_pub_lock = threading.Lock()
 
 app = Flask(__name__)
 ds_client  = ndb.Client()
-ppc_client = pubsub.PublisherClient()
+if hasattr(pubsub.types, 'PublishFlowControl'):  # google-cloud-pubsub>=2.2
+    ppc_client = pubsub.PublisherClient(PUB_BATCH,
+            publisher_options=pubsub.types.PublisherOptions(
+                flow_control=pubsub.types.PublishFlowControl(
+                    message_limit=PUB_FLOW_MSGS,
+                    limit_exceeded_behavior=pubsub.types.LimitExceededBehavior.BLOCK)))
+else:
+    ppc_client = pubsub.PublisherClient(PUB_BATCH)
+if hasattr(ppc_client, 'stop'):  # send any batched messages at shutdown
+    atexit.register(ppc_client.stop)
 psc_client = pubsub.SubscriberClient()
 _, PROJECT_ID = google.auth.default()
 TOP_PATH = ppc_client.topic_path(PROJECT_ID, TOPIC)
@@ -35,11 +90,61 @@ class Visit(ndb.Model):
     visitor   = ndb.StringProperty()
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
 
+def _published(future):
+    'publish callback counting successes & (logged) failures'
+    failed = future.exception()
+    if failed:
+        logging.warning('publish failed: %s', failed)
+    with _pub_lock:
+        PUB_STATS['failed' if failed else 'published'] += 1
+
+def publish_count(visitor, count=1):
+    'publish (batched, asynchronously) message to bump visitor count'
+    future = ppc_client.publish(TOP_PATH, visitor.encode('utf-8'),
+            count=str(count))
+    future.add_done_callback(_published)
+
+
+class CountAggregator(object):
+    'sums visits per visitor, publishing one message per visitor per window'
+    def __init__(self, window):
+        self.window = window
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.publisher = threading.Thread(target=self._run)
+        self.publisher.daemon = True
+        self.publisher.start()
+        atexit.register(self.flush)
+
+    def add(self, visitor):
+        'count a visit by visitor'
+        with self.lock:
+            self.counts[visitor] = self.counts.get(visitor, 0) + 1
+
+    def flush(self):
+        'publish (& reset) aggregated counts'
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        for visitor, count in counts.items():
+            publish_count(visitor, count)
+
+    def _run(self):
+        'publisher thread: flush counts every window'
+        while True:
+            time.sleep(self.window)
+            self.flush()
+
+COUNTS = CountAggregator(AGGREGATE_SECS) if AGGREGATE_SECS > 0 else None
+
+
 def store_visit(remote_addr, user_agent):
     'create new Visit in Datastore and queue request to bump visitor count'
     with ds_client.context():
         Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
-    ppc_client.publish(TOP_PATH, remote_addr.encode('utf-8'))
+    if COUNTS:
+        COUNTS.add(remote_addr)
+    else:
+        publish_count(remote_addr)
 
 def fetch_visits(limit):
     'get most recent visits'
@@ -48,19 +153,287 @@ def fetch_visits(limit):
 
 
 class VisitorCount(ndb.Model):
+    'VisitorCount entity (keyed by visitor) tallies visits per visitor'
     visitor = ndb.StringProperty(repeated=False, required=True)
-    counter = ndb.IntegerProperty()
+    counter = ndb.IntegerProperty(indexed=not UNINDEXED_COUNTS)
+
+@ndb.transactional(xg=True)
+def _add_counts(tallies):
+    'add tallies to (keyed-by-visitor) counts in a single transaction'
+    keys = [ndb.Key(VisitorCount, visitor) for visitor in tallies]
+    counts = []
+    for key, count in zip(keys, ndb.get_multi(keys)):
+        count = count or VisitorCount(key=key, visitor=key.id(), counter=0)
+        count.counter += tallies[key.id()]
+        counts.append(count)
+    ndb.put_multi(counts)
+    return {count.visitor: count.counter for count in counts}
+
+def update_counts(tallies, committed=None):
+    'add tallies to visitor counts, TX_SIZE visitors per transaction'
+    # committed (if given) is called with the visitors of each committed chunk
+    committed = committed or (lambda visitors: None)
+    with ds_client.context():
+        if APPROX:
+            return update_approx_counts(tallies, committed)
+        if SHARDED:
+            totals = update_sharded_counts(tallies, committed)
+        else:
+            totals = {}
+            visitors = list(tallies)
+            for i in range(0, len(visitors), TX_SIZE):
+                chunk = visitors[i:i+TX_SIZE]
+                totals.update(_add_counts({v: tallies[v] for v in chunk}))
+                committed(chunk)
+        if LEADERBOARD and totals:
+            update_board(totals)
+    return totals
+
+@ndb.transactional(xg=True)
+def _rekey_count(old_key):
+    'move legacy (auto-ID) count into its keyed-by-visitor entity'
+    old = old_key.get()
+    if old:
+        key = ndb.Key(VisitorCount, old.visitor)
+        count = key.get() or VisitorCount(key=key, visitor=old.visitor, counter=0)
+        count.counter += old.counter or 0
+        count.put()
+        old_key.delete()
+
+
+class VisitorCountShard(ndb.Model):
+    'partial visit count for a visitor; shard 0 also holds the shard count'
+    counter = ndb.IntegerProperty(indexed=False)
+    shards  = ndb.IntegerProperty(indexed=False)
+
+def _shard_key(visitor, shard):
+    'key of visitor count shard'
+    return ndb.Key(VisitorCountShard, '%s#%d' % (visitor, shard))
+
+@ndb.transactional(xg=True)
+def _set_shards(visitors, hot):
+    'start (w/any unsharded count) or grow (if hot) shard 0 of each visitor'
+    keys = [_shard_key(v, 0) for v in visitors]
+    firsts = ndb.get_multi(keys)
+    new = [v for v, first in zip(visitors, firsts) if not first]
+    counts = dict(zip(new, ndb.get_multi(
+            [ndb.Key(VisitorCount, v) for v in new])))
+    shards, changed = {}, []
+    for visitor, key, first in zip(visitors, keys, firsts):
+        if not first:   # start sharding, keeping any earlier count
+            count = counts[visitor]
+            first = VisitorCountShard(key=key, shards=SHARDS,
+                    counter=count.counter if count else 0)
+            changed.append(first)
+        elif visitor in hot and first.shards < MAX_SHARDS:
+            first.shards = min(first.shards * 2, MAX_SHARDS)
+            changed.append(first)
+        shards[visitor] = first.shards
+    ndb.put_multi(changed)
+    return shards
+
+@ndb.transactional(xg=True)
+def _add_shard_counts(tallies):
+    'add tallies to (keyed) visitor count shards in a single transaction'
+    shards = []
+    for key, shard in zip(tallies, ndb.get_multi(list(tallies))):
+        shard = shard or VisitorCountShard(key=key, counter=0)
+        shard.counter += tallies[key]
+        shards.append(shard)
+    ndb.put_multi(shards)
+
+def update_sharded_counts(tallies, committed):
+    'add tallies to random visitor count shards, then refresh their totals'
+    # look up (or start, or grow for hot visitors) each visitor's shard count
+    visitors = list(tallies)
+    hot = set(v for v in visitors if tallies[v] >= HOT_TALLY)
+    shards, todo = {}, []
+    for visitor, first in zip(visitors,
+            ndb.get_multi([_shard_key(v, 0) for v in visitors])):
+        if first and not (visitor in hot and first.shards < MAX_SHARDS):
+            shards[visitor] = first.shards
+        else:
+            todo.append(visitor)
+    step = TX_SIZE // 2     # (2 entity groups per new visitor)
+    for i in range(0, len(todo), step):
+        shards.update(_set_shards(todo[i:i+step], hot))
+
+    # add tallies to a random shard each, TX_SIZE shards per transaction
+    incs = {_shard_key(v, random.randrange(shards[v])): tallies[v]
+            for v in visitors}
+    keys = list(incs)
+    for i in range(0, len(keys), TX_SIZE):
+        _add_shard_counts({k: incs[k] for k in keys[i:i+TX_SIZE]})
+        committed([k.id().rsplit('#', 1)[0] for k in keys[i:i+TX_SIZE]])
+
+    # cache sums of shards as VisitorCount totals (blind writes: no conflicts)
+    # but only every HOT_SECS (per process) for hot (grown) visitors, so their
+    # VisitorCount isn't rewritten by every batch of every worker; hot ones
+    # stay overdue until refreshed, by a later (even empty) batch if need be
+    now = time.time()
+    _overdue.update((v, shards[v]) for v in visitors if shards[v] > SHARDS)
+    due = {v: shards[v] for v in visitors if shards[v] <= SHARDS}
+    due.update((v, n) for v, n in list(_overdue.items())
+            if now - _refreshed.get(v, 0) >= HOT_SECS)
+    keys = [_shard_key(v, i) for v in due for i in range(due[v])]
+    totals = dict.fromkeys(due, 0)
+    for key, shard in zip(keys, ndb.get_multi(keys)):
+        totals[key.id().rsplit('#', 1)[0]] += shard.counter if shard else 0
+    ndb.put_multi([VisitorCount(key=ndb.Key(VisitorCount, v), visitor=v,
+            counter=n) for v, n in totals.items()])
+    for visitor in due:
+        if _overdue.pop(visitor, None):
+            _refreshed[visitor] = now
+    return totals
+
+
+class TopVisitors(ndb.Model):
+    'leaderboard entity holding the TOP_K visitor counts, highest first'
+    counts = ndb.LocalStructuredProperty(VisitorCount, repeated=True)
+
+def _board_key():
+    'key of (single) leaderboard entity'
+    return ndb.Key(TopVisitors, 'top')
+
+@ndb.transactional()
+def update_board(totals):
+    'merge (new) visitor totals into leaderboard, keeping the TOP_K'
+    # counts only grow, so keep the larger of board & batch total (batches
+    # may merge out of order), & visitors not in this batch keep their places
+    board = _board_key().get() or TopVisitors(key=_board_key())
+    merged = {count.visitor: count.counter for count in board.counts}
+    for visitor, counter in totals.items():
+        merged[visitor] = max(merged.get(visitor, 0), counter)
+    board.counts = [VisitorCount(visitor=visitor, counter=counter)
+            for visitor, counter in heapq.nlargest(
+                TOP_K, merged.items(), key=lambda item: item[1])]
+    board.put()
+
+
+class VisitorSketch(ndb.Model):
+    'approximate visitor counts: Count-Min & Space-Saving blobs, mergeable'
+    sketch = ndb.BlobProperty()
+    heavy = ndb.BlobProperty()
+
+@ndb.transactional()
+def _add_sketch(key, tallies):
+    'add tallies to one sketch entity'
+    entity = key.get() or VisitorSketch(key=key)
+    cms = CountMin.loads(entity.sketch) if entity.sketch else CountMin()
+    ssv = SpaceSaving.loads(entity.heavy) if entity.heavy else SpaceSaving()
+    for visitor, tally in tallies.items():
+        cms.add(visitor, tally)
+        ssv.add(visitor, tally)
+    entity.sketch, entity.heavy = cms.dumps(), ssv.dumps()
+    entity.put()
+
+def update_approx_counts(tallies, committed):
+    'add tallies to a random sketch entity (spreads concurrent workers)'
+    if not tallies:     # (empty lease/pull: skip rewriting a whole sketch)
+        return {}
+    _add_sketch(ndb.Key(VisitorSketch, 'sketch%d' % random.randrange(
+            SKETCHES)), tallies)
+    committed(list(tallies))
+    return {}
+
+def fetch_approx_counts(limit):
+    'merge sketch entities, get top visitors with tightest estimates'
+    cms, ssv = CountMin(), SpaceSaving()
+    for entity in ndb.get_multi([ndb.Key(VisitorSketch, 'sketch%d' % i)
+            for i in range(SKETCHES)]):
+        if entity:
+            cms.merge(CountMin.loads(entity.sketch))
+            ssv.merge(SpaceSaving.loads(entity.heavy))
+    # both overestimate, so the smaller is closer
+    counts = [VisitorCount(visitor=visitor, counter=min(count,
+            cms.estimate(visitor))) for visitor, count, error in ssv.top(limit)]
+    return sorted(counts, key=lambda count: -count.counter)
 
 def fetch_counts(limit):
     'get top visitors'
     with ds_client.context():
-        return VisitorCount.query().order(-VisitorCount.counter).fetch(limit)
+        if APPROX:
+            return fetch_approx_counts(limit)
+        if not LEADERBOARD:
+            return VisitorCount.query().order(
+                    -VisitorCount.counter).fetch(limit)
+        board = _board_key().get()  # (seeded by /migrate)
+        return board.counts[:limit] if board else []
+
+
+class TallyBuffer(object):
+    'tallies streamed messages, flushing counts to Datastore in batches'
+    def __init__(self, flush_secs, flush_msgs):
+        self.flush_secs, self.flush_msgs = flush_secs, flush_msgs
+        self.tallies, self.msgs, self.pending = {}, {}, 0
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def add(self, msg):
+        'subscriber callback: tally message (acked once flushed)'
+        visitor = msg.data.decode('utf-8')
+        count = int(msg.attributes.get('count', 1))
+        with self.cond:
+            self.tallies[visitor] = self.tallies.get(visitor, 0) + count
+            self.msgs.setdefault(visitor, []).append(msg)
+            self.pending += 1
+            if self.pending >= self.flush_msgs:
+                self.cond.notify()
+
+    def flush(self):
+        'commit pending tallies, acking messages as their chunk commits'
+        with self.cond:
+            tallies, msgs, pending = self.tallies, self.msgs, self.pending
+            self.tallies, self.msgs, self.pending = {}, {}, 0
+        if not msgs and not _overdue:   # (else refresh lagging hot totals)
+            return
+        def committed(visitors):
+            'ack messages of visitors whose counts were just committed'
+            for visitor in visitors:
+                for msg in msgs.pop(visitor, ()):
+                    msg.ack()
+        try:
+            update_counts(tallies, committed)
+        except Exception:
+            logging.exception('flush of %d message(s) failed', pending)
+            # nack only uncommitted ones: committed chunks are already acked,
+            # so redelivery can't count them twice
+            for visitor_msgs in msgs.values():
+                for msg in visitor_msgs:
+                    msg.nack()
+            return
+        committed(list(msgs))
+
+    def _run(self):
+        'flusher thread: flush every flush_secs or once flush_msgs pending'
+        while True:
+            deadline = time.time() + self.flush_secs
+            with self.cond:
+                while self.pending < self.flush_msgs and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+            self.flush()
+
+def start_streaming():
+    'stream-pull visitor messages (with flow control) into a TallyBuffer'
+    tallies = TallyBuffer(FLUSH_SECS, FLUSH_MSGS)
+    future = psc_client.subscribe(SUB_PATH, callback=tallies.add,
+            flow_control=pubsub.types.FlowControl(max_messages=FLOW_MSGS))
+    def stop():
+        'at shutdown, flush (& ack) what we have then stop streaming'
+        tallies.flush()
+        future.cancel()
+    atexit.register(stop)
+    return future
+
+STREAM = start_streaming() if STREAMING else None
 
 
 @app.route('/log')
 def log_visitors():
     'worker processes recent visitor counts and updates them in Datastore'
-    # tally recent visitor counts from queue then delete those tasks
+    # tally recent visitor counts from queue (long-lived client kept open)
     tallies = {}
     acks = set()
     rsp = psc_client.pull(subscription=SUB_PATH, max_messages=TASKS)
@@ -68,28 +441,34 @@ def log_visitors():
     for rcvd_msg in msgs:
         acks.add(rcvd_msg.ack_id)
         visitor = rcvd_msg.message.data.decode('utf-8')
-        tallies[visitor] = tallies.get(visitor, 0) + 1
+        count = int(rcvd_msg.message.attributes.get('count', 1))
+        tallies[visitor] = tallies.get(visitor, 0) + count
+
+    # increment those counts in Datastore, then ack (delete) those messages
+    update_counts(tallies)
     if acks:
         psc_client.acknowledge(subscription=SUB_PATH, ack_ids=acks)
-    try:
-        psc_client.close()
-    except AttributeError:  # special Py2 handler for grpcio<1.12.0
-        pass
-
-    # increment those counts in Datastore and return
-    if tallies:
-        with ds_client.context():
-            for visitor in tallies:
-                counter = VisitorCount.query(VisitorCount.visitor == visitor).get()
-                if not counter:
-                    counter = VisitorCount(visitor=visitor, counter=0)
-                    counter.put()
-                counter.counter += tallies[visitor]
-                counter.put()
     return 'DONE (with %d task[s] logging %d visitor[s])\r\n' % (
             len(msgs), len(tallies))
 
 
+@app.route('/migrate')
+def migrate_counts():
+    'one-time re-keying of (up to TASKS) legacy auto-ID VisitorCounts'
+    moved = 0
+    with ds_client.context():
+        if LEADERBOARD and not _board_key().get():  # seed from all counts
+            update_board({count.visitor: count.counter
+                    for count in VisitorCount.query()})
+        for key in VisitorCount.query().iter(keys_only=True):
+            if key.integer_id() is not None:
+                _rekey_count(key)
+                moved += 1
+                if moved >= TASKS:
+                    break
+    return 'DONE (re-keyed %d visitor count[s])\r\n' % moved
+
+
 @app.route('/')
 def root():
     'main application (GET) handler'
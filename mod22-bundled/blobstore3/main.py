@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import timedelta
+import os
+import threading
+import time
+
 from flask import Flask, abort, redirect, request
 from google.appengine.api import wrap_wsgi_app
 from google.appengine.ext import blobstore, ndb
+from google.auth.credentials import Signing
+from google.auth.transport.requests import Request
+from google.cloud import storage
 
 UPLOAD_FORM = '''\
 <title>Module 22 Blobstore sample app</title>
@@ -26,10 +34,23 @@ UPLOAD_FORM = '''\
 app = Flask(__name__)
 app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
 
+# optional redirects to signed URLs (off by default; see README)
+SIGNED = os.environ.get('SIGNED_URLS', '').lower() in ('1', 'true', 'yes')
+SIGNED_TTL = 900    # secs signed URLs are valid for...
+SIGNED_SLACK = 60   # ...less secs before expiry they stop being reused
+SIGNED_CACHE = 1000 # max signed URLs cached
+GCS_ENDPOINT = os.environ.get('STORAGE_EMULATOR_HOST')  # e.g., local fake GCS
+BUCKET = os.environ.get('GCS_BUCKET',
+        '%s.appspot.com' % os.environ.get('GOOGLE_CLOUD_PROJECT'))
+gcs_client = storage.Client() if SIGNED else None
+_signed = {}
+_signed_lock = threading.Lock()
+
 
 class PhotoUpload(ndb.Model):
     'PhotoUpload entity for registering a photo'
     blob_key = ndb.BlobKeyProperty()
+    gcs_object = ndb.StringProperty(indexed=False)  # '/gs/bucket/name'
 
 
 class PhotoUploadHandler(blobstore.BlobstoreUploadHandler):
@@ -37,7 +58,12 @@ class PhotoUploadHandler(blobstore.BlobstoreUploadHandler):
     def post(self):
         uploads = self.get_uploads(request.environ)
         blob_id = uploads[0].key() if uploads else None
-        PhotoUpload(blob_key=blob_id).put()
+        if SIGNED and blob_id:  # (GCS-backed) upload keyed for lookup by view
+            infos = self.get_file_infos(request.environ)
+            PhotoUpload(id=str(blob_id), blob_key=blob_id,
+                    gcs_object=infos[0].gs_object_name).put()
+        else:
+            PhotoUpload(blob_key=blob_id).put()
         return redirect('/view_photo/%s' % blob_id)
 
 @app.route('/upload_photo', methods=['POST'])
@@ -46,6 +72,40 @@ def upload_photo():
     return PhotoUploadHandler().post()
 
 
+def _sign(gcs_object):
+    'V4 signed URL for "/gs/<bucket>/<object>"'
+    creds, kwargs = gcs_client._credentials, {}
+    if not isinstance(creds, Signing):  # no private key: sign via IAM API
+        if not creds.valid:
+            creds.refresh(Request())
+        kwargs.update(service_account_email=creds.service_account_email,
+                access_token=creds.token)
+    if GCS_ENDPOINT:
+        kwargs['api_access_endpoint'] = GCS_ENDPOINT
+    bucket, name = gcs_object[len('/gs/'):].split('/', 1)
+    return gcs_client.bucket(bucket).blob(name).generate_signed_url(
+            version='v4', expiration=timedelta(seconds=SIGNED_TTL),
+            method='GET', **kwargs)
+
+def signed_url(photo_key):
+    'get (cached) V4 signed URL for GCS-backed photo, or None if not one'
+    now = time.time()
+    with _signed_lock:
+        url, expires = _signed.get(photo_key, (None, 0))
+    if expires - SIGNED_SLACK > now:
+        return url
+    photo = PhotoUpload.get_by_id(photo_key)
+    if photo and photo.gcs_object:
+        url = _sign(photo.gcs_object)
+    else:   # legacy (Blobstore) photo: cache the miss too
+        url = None
+    with _signed_lock:
+        if len(_signed) >= SIGNED_CACHE:
+            _signed.clear()
+        _signed[photo_key] = (url, now + SIGNED_TTL)
+    return url
+
+
 class ViewPhotoHandler(blobstore.BlobstoreDownloadHandler):
     'ViewPhotoHandler handles a photo view/download (GET)'
     def get(self, blob_key):
@@ -58,10 +118,14 @@ class ViewPhotoHandler(blobstore.BlobstoreDownloadHandler):
 @app.route('/view_photo/<photo_key>')
 def view_photo(photo_key):
     'call download handler for view (GET) request'
+    url = signed_url(photo_key) if SIGNED else None
+    if url:     # browser downloads directly from Cloud Storage
+        return redirect(url)
     return ViewPhotoHandler().get(photo_key)
 
 
 @app.route('/')
 def upload_form():
     'display photo upload HTML form'
-    return UPLOAD_FORM % blobstore.create_upload_url('/upload_photo')
+    return UPLOAD_FORM % blobstore.create_upload_url('/upload_photo',
+            gs_bucket_name=BUCKET if SIGNED else None)
@@ -12,30 +12,256 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
 from flask import Flask, render_template, request
 from google.cloud import ndb
 
 app = Flask(__name__)
 ds_client = ndb.Client()
 
+# optional write-behind of Visits (off by default; see README)
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+WB_MAX_SIZE = int(os.environ.get('WB_MAX_SIZE', 1000))  # max buffered Visits
+WB_BATCH = int(os.environ.get('WB_BATCH', 100))         # flush this many...
+WB_MAX_AGE = float(os.environ.get('WB_MAX_AGE', 2.0))   # ...or after (secs)
+
+# optional materialized "recent visits" summary (off by default; see README)
+RECENT_VISITS = os.environ.get('RECENT_VISITS', '').lower() in ('1', 'true', 'yes')
+RV_SIZE = int(os.environ.get('RV_SIZE', 10))        # visits kept per shard
+RV_SHARDS = int(os.environ.get('RV_SHARDS', 1))     # summary entities
+RV_CHECK = float(os.environ.get('RV_CHECK', 0.01))  # share of reads verified
+
+# optional scattered timestamp index (off by default; see README)
+SCATTER = int(os.environ.get('SCATTER_SHARDS', 0))  # shards (0: unsharded)
+
+# optional concurrent store & fetch in root() (off by default; see README)
+CONCURRENT = os.environ.get('CONCURRENT_ROOT', '').lower() in ('1', 'true', 'yes')
+
+def _scatter(visit):
+    'shard-prefixed timestamp, so recent Visits spread over SCATTER ranges'
+    if visit.shard is not None and visit.timestamp:
+        return '%03d|%s' % (visit.shard,
+                visit.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
     visitor   = ndb.StringProperty()
-    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True, indexed=not SCATTER)
+    if SCATTER:     # index shard-prefixed (not bare) timestamps; see README
+        shard   = ndb.IntegerProperty(indexed=False)
+        scatter = ndb.ComputedProperty(_scatter)
+
+        def _pre_put_hook(self):
+            if self.shard is None:
+                self.shard = random.randrange(SCATTER)
+
+def query_visits(limit):
+    'get most recent Visits, one query per shard if scattered (within context)'
+    if not SCATTER:
+        return Visit.query().order(-Visit.timestamp).fetch(limit)
+    futures = [Visit.query(Visit.scatter >= '%03d|' % i,
+            Visit.scatter < '%03d}' % i).order(-Visit.scatter).fetch_async(
+            limit) for i in range(SCATTER)]     # run concurrently...
+    return list(itertools.islice(heapq.merge(     # ...then merge newest
+            *[f.result() for f in futures], key=lambda v: v.timestamp,
+            reverse=True), limit))
+
+
+class RecentVisits(ndb.Model):
+    'summary entity (shard) holding its most recent visits, newest first'
+    visits = ndb.LocalStructuredProperty(Visit, repeated=True)
+
+def _rv_keys():
+    'keys of all recent-visits summary shards (call within context)'
+    return [ndb.Key(RecentVisits, 'shard%d' % i) for i in range(RV_SHARDS)]
+
+def _newest(visits, limit):
+    'drop duplicate visits and return the `limit` most recent'
+    uniq = {(v.visitor, v.timestamp): v for v in visits}
+    return sorted(uniq.values(), key=lambda v: v.timestamp, reverse=True)[:limit]
+
+@ndb.transactional()
+def _add_recent(visits):
+    'merge (already-written) visits into a random summary shard'
+    key = random.choice(_rv_keys())
+    recent = key.get() or RecentVisits(key=key)
+    recent.visits = _newest(visits + recent.visits, RV_SIZE)
+    recent.put()
+
+def record_recent(visits):
+    'best-effort update of recent-visits summary (call within context)'
+    try:
+        _add_recent(visits)
+    except Exception:
+        logging.exception('recent-visits summary update failed')
+
+def fetch_recent(limit):
+    'get most recent visits from summary shards (call within context)'
+    return _newest([v for recent in ndb.get_multi(_rv_keys()) if recent
+            for v in recent.visits], limit)
+
+@ndb.transactional(xg=True)
+def _reset_recent(visits):
+    'rebuild summary shards from query results, keeping any newer visits'
+    # (visits merged in since the query ran are newer than all its results)
+    keys = _rv_keys()
+    newer = [v for recent in ndb.get_multi(keys) if recent
+            for v in recent.visits if not visits or
+            v.timestamp > visits[0].timestamp]
+    ndb.put_multi([RecentVisits(key=key, visits=_newest(newer + visits,
+            RV_SIZE) if i == 0 else []) for i, key in enumerate(keys)])
+
+def check_recent(recent, query):
+    'compare summary to query results & rebuild summary if they differ'
+    # visits newer than the summary's newest may just not be merged in yet
+    visits = [v for v in query if not recent or
+            v.timestamp <= recent[0].timestamp]
+    if [(v.visitor, v.timestamp) for v in recent[:len(visits)]] != [
+            (v.visitor, v.timestamp) for v in visits]:
+        logging.warning('recent-visits summary stale; rebuilding from query')
+        try:
+            _reset_recent(query)
+        except Exception:
+            logging.exception('recent-visits summary rebuild failed')
+
+
+class VisitBuffer(object):
+    'bounded in-process buffer writing Visits to Datastore in batches'
+    def __init__(self, max_size, batch, max_age):
+        self.max_size, self.batch, self.max_age = max_size, batch, max_age
+        self.visits = []        # pending Visits, oldest first
+        self.oldest = None      # time.time() when oldest pending Visit arrived
+        self.dropped = 0        # Visits lost to a full buffer or failed flush
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.close)
+
+    @property
+    def pending(self):
+        'number of Visits buffered but not yet written'
+        return len(self.visits)
+
+    def add(self, visit):
+        'buffer Visit for writing; drop (and count) it if buffer is full'
+        with self.cond:
+            if self.closed or len(self.visits) >= self.max_size:
+                self.dropped += 1
+                return False
+            if not self.visits:
+                self.oldest = time.time()
+            self.visits.append(visit)
+            if len(self.visits) >= self.batch:
+                self.cond.notify()
+        return True
+
+    def recent(self):
+        'pending (not yet written) Visits, most recent first'
+        with self.cond:
+            return self.visits[::-1]
+
+    def close(self, timeout=10):
+        'stop accepting Visits and drain buffer (called at shutdown)'
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join(timeout)
+
+    def _due(self):
+        'whether a flush is due (call with lock held)'
+        return self.closed or len(self.visits) >= self.batch or (
+                self.visits and time.time() - self.oldest >= self.max_age)
+
+    def _run(self):
+        'flusher thread: write a batch when big enough or old enough'
+        while True:
+            with self.cond:
+                while not self._due():
+                    self.cond.wait(self.max_age if not self.visits else
+                            max(0, self.oldest + self.max_age - time.time()))
+                if self.closed and not self.visits:
+                    return
+                batch = self.visits[:self.batch]
+                self.visits = self.visits[self.batch:]
+                self.oldest = time.time() if self.visits else None
+            if not self._write(batch) and not self.closed:
+                time.sleep(self.max_age)    # back off before retrying
+
+    def _write(self, batch):
+        'put_multi() batch of Visits, re-queuing what fits on failure'
+        try:
+            with ds_client.context():
+                ndb.put_multi(batch)
+                if RECENT_VISITS:
+                    record_recent(batch)
+            return True
+        except Exception:
+            logging.exception('write-behind of %d Visit(s) failed', len(batch))
+        with self.cond:
+            kept = [] if self.closed else batch[:self.max_size-len(self.visits)]
+            self.visits[:0] = kept
+            if kept and self.oldest is None:
+                self.oldest = time.time()
+            self.dropped += len(batch) - len(kept)
+        return False
+
+VISITS = VisitBuffer(WB_MAX_SIZE, WB_BATCH, WB_MAX_AGE) if WRITE_BEHIND else None
 
 def store_visit(remote_addr, user_agent):
-    'create new Visit entity in Datastore'
+    'create new Visit entity in Datastore (or buffer it for write-behind)'
+    visitor = '{}: {}'.format(remote_addr, user_agent)
+    if VISITS:
+        VISITS.add(Visit(visitor=visitor, timestamp=datetime.utcnow()))
+        return
     with ds_client.context():
-        Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
+        visit = Visit(visitor=visitor)
+        visit.put()
+        if RECENT_VISITS:
+            record_recent([visit])
 
 def fetch_visits(limit):
-    'get most recent visits'
+    'get most recent visits (including any not yet written)'
     with ds_client.context():
-        return Visit.query().order(-Visit.timestamp).fetch(limit)
+        visits = fetch_recent(limit) if RECENT_VISITS else []
+        # fall back to (and sometimes verify against) the ordered query
+        check = RECENT_VISITS and random.random() < RV_CHECK
+        if len(visits) < limit or check:
+            recent = visits
+            visits = query_visits(limit)
+            if check:   # (a short summary is just still filling up)
+                check_recent(recent, visits)
+    if VISITS:
+        visits = (VISITS.recent() + visits)[:limit]
+    return visits
+
+def store_and_fetch(remote_addr, user_agent, limit):
+    'store new Visit while fetching most recent ones, merging it in'
+    with ds_client.context():
+        visit = Visit(visitor='{}: {}'.format(remote_addr, user_agent))
+        stored = visit.put_async()
+        visits = query_visits(limit)    # event loop runs put meanwhile
+        stored.check_success()
+        if RECENT_VISITS:
+            record_recent([visit])
+    # query may or may not have seen it
+    return [visit] + [v for v in visits if v.key != visit.key][:limit-1]
 
 @app.route('/')
 def root():
     'main application (GET) handler'
+    if CONCURRENT and not VISITS:   # (write-behind doesn't wait on writes)
+        visits = store_and_fetch(request.remote_addr, request.user_agent, 10)
+        return render_template('index.html', visits=visits)
     store_visit(request.remote_addr, request.user_agent)
     visits = fetch_visits(10)
     return render_template('index.html', visits=visits)
@@ -0,0 +1,43 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare Visit write throughput (and fetch latency) with a bare timestamp
+index vs. SCATTER_SHARDS shard-prefixed ones, against the Datastore emulator:
+gcloud beta emulators datastore start --no-store-on-disk, then
+DATASTORE_EMULATOR_HOST=localhost:8081 GOOGLE_CLOUD_PROJECT=test
+python bench_scatter.py. (The emulator has no tablets to hotspot, so this
+measures the scheme's overhead; the gain shows up on real Datastore.)
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+import main
+
+WRITES = 2000
+THREADS = 32
+
+for shards in (0, 4, 16):
+    main.SCATTER = shards
+    main._scatter_pool = ThreadPoolExecutor(shards) if shards else None
+    with ThreadPoolExecutor(THREADS) as pool:
+        start = time.time()
+        list(pool.map(lambda i: main.store_visit('10.0.0.%d' % (i % 256),
+                'bench'), range(WRITES)))
+        secs = time.time() - start
+    start = time.time()
+    visits = main.fetch_visits(10)
+    fetch = time.time() - start
+    print('%2d shards: %6.1f writes/s; fetch_visits(10) %5.1fms (%d visits)'
+            % (shards, WRITES / secs, fetch * 1000, len(visits)))
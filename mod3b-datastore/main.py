@@ -12,31 +12,76 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import heapq
+import itertools
+import os
+import random
 from flask import Flask, render_template, request
 from google.cloud import datastore
 
 app = Flask(__name__)
 ds_client = datastore.Client()
 
+# optional scattered timestamp index (off by default; see README)
+SCATTER = int(os.environ.get('SCATTER_SHARDS', 0))  # shards (0: unsharded)
+_scatter_pool = ThreadPoolExecutor(SCATTER) if SCATTER else None
+
+# optional concurrent store & fetch in root() (off by default; see README)
+CONCURRENT = os.environ.get('CONCURRENT_ROOT', '').lower() in ('1', 'true', 'yes')
+_store_pool = ThreadPoolExecutor(8) if CONCURRENT else None
+
 def store_visit(remote_addr, user_agent):
     'create new Visit entity in Datastore'
-    entity = datastore.Entity(key=ds_client.key('Visit'))
+    if SCATTER:     # index shard-prefixed (not bare) timestamps; see README
+        entity = datastore.Entity(key=ds_client.key('Visit'),
+                exclude_from_indexes=('timestamp',))
+        now, shard = datetime.now(), random.randrange(SCATTER)
+        entity['scatter'] = '%03d|%s' % (
+                shard, now.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+    else:
+        entity = datastore.Entity(key=ds_client.key('Visit'))
+        now = datetime.now()
     entity.update({
-        'timestamp': datetime.now(),
+        'timestamp': now,
         'visitor': '{}: {}'.format(remote_addr, user_agent),
     })
     ds_client.put(entity)
+    return entity
+
+def _fetch_shard(shard, limit):
+    'get most recent visits of one scatter shard'
+    query = ds_client.query(kind='Visit')
+    query.add_filter('scatter', '>=', '%03d|' % shard)
+    query.add_filter('scatter', '<', '%03d}' % shard)
+    query.order = ['-scatter']
+    return list(query.fetch(limit=limit))
 
 def fetch_visits(limit):
     'get most recent visits'
+    if SCATTER:     # query shards concurrently, then merge newest
+        shards = _scatter_pool.map(_fetch_shard, range(SCATTER),
+                [limit] * SCATTER)
+        return list(itertools.islice(heapq.merge(*shards,
+                key=lambda v: v['timestamp'], reverse=True), limit))
     query = ds_client.query(kind='Visit')
     query.order = ['-timestamp']
     return query.fetch(limit=limit)
 
+def store_and_fetch(remote_addr, user_agent, limit):
+    'store new Visit while fetching most recent ones, merging it in'
+    stored = _store_pool.submit(store_visit, remote_addr, user_agent)
+    visits = list(fetch_visits(limit))
+    entity = stored.result()    # fetch may or may not have seen it
+    return [entity] + [v for v in visits if v.key != entity.key][:limit-1]
+
 @app.route('/')
 def root():
     'main application (GET) handler'
+    if CONCURRENT:
+        visits = store_and_fetch(request.remote_addr, request.user_agent, 10)
+        return render_template('index.html', visits=visits)
     store_visit(request.remote_addr, request.user_agent)
     visits = fetch_visits(10)
     return render_template('index.html', visits=visits)
@@ -12,31 +12,202 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import atexit
+import collections
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
 from flask import Flask, render_template, request
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions
 
 app = Flask(__name__)
 fs_client = firestore.Client()
 
+# optional scattered timestamp index (off by default; see README)
+SCATTER = int(os.environ.get('SCATTER_SHARDS', 0))  # shards (0: unsharded)
+_scatter_pool = ThreadPoolExecutor(SCATTER) if SCATTER else None
+
+# optional concurrent store & fetch in root() (off by default; see README)
+CONCURRENT = os.environ.get('CONCURRENT_ROOT', '').lower() in ('1', 'true', 'yes')
+_store_pool = ThreadPoolExecutor(8) if CONCURRENT else None
+
+# optional buffered (BulkWriter) writes of visits (off by default; see README)
+BULK_WRITES = os.environ.get('BULK_WRITES', '').lower() in ('1', 'true', 'yes')
+BW_MAX_SIZE = int(os.environ.get('BW_MAX_SIZE', 5000))  # max buffered visits
+BW_BATCH = int(os.environ.get('BW_BATCH', 500))         # flush this many...
+BW_MAX_AGE = float(os.environ.get('BW_MAX_AGE', 1.0))   # ...or after (secs)
+BW_ATTEMPTS = 5     # retries per failed visit write
+BW_MAX_DELAY = 5.0  # max secs paused between flushes under contention
+CONTENTION = {8, 10}    # gRPC RESOURCE_EXHAUSTED, ABORTED
+RETRYABLE = CONTENTION | {4, 13, 14}  # + DEADLINE_EXCEEDED, INTERNAL, UNAVAIL.
+
+class VisitWriter(object):
+    'bounded in-process buffer writing visits to Firestore via BulkWriter'
+    def __init__(self, max_size, batch, max_age):
+        self.max_size, self.batch, self.max_age = max_size, batch, max_age
+        self.visits = []        # pending visits, oldest first
+        self.oldest = None      # time.time() when oldest pending visit arrived
+        self.delay = 0.0        # secs paused between flushes (contention)
+        self.stats = collections.Counter()  # written, failed, dropped, ...
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def add(self, visit):
+        'buffer visit for writing; drop (and count) it if buffer is full'
+        with self.cond:
+            if self.closed or len(self.visits) >= self.max_size:
+                self.stats['dropped'] += 1
+                return False
+            if not self.visits:
+                self.oldest = time.time()
+            self.visits.append(visit)
+            if len(self.visits) >= self.batch:
+                self.cond.notify()
+        return True
+
+    def recent(self):
+        'pending (not yet written) visits, most recent first'
+        with self.cond:
+            return self.visits[::-1]
+
+    def close(self, timeout=10):
+        'stop accepting visits and drain buffer (called at shutdown)'
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join(timeout)
+
+    def _on_result(self, reference, result, writer):
+        with self.cond:
+            self.stats['written'] += 1
+
+    def _on_error(self, failure, writer):
+        'retry retryable write errors (BulkWriter backs off) BW_ATTEMPTS times'
+        with self.cond:
+            if failure.code in CONTENTION:
+                self.stats['contention'] += 1
+            if failure.code in RETRYABLE and failure.attempts < BW_ATTEMPTS:
+                self.stats['retried'] += 1
+                return True
+            self.stats['failed'] += 1
+            self.stats['dropped'] += 1
+        logging.warning('visit write failed: %s', failure.message)
+        return False
+
+    def _due(self):
+        'whether a flush is due (call with lock held)'
+        return self.closed or len(self.visits) >= self.batch or (
+                self.visits and time.time() - self.oldest >= self.max_age)
+
+    def _run(self):
+        'flusher thread: write a batch when big enough or old enough'
+        while True:
+            with self.cond:
+                while not self._due():
+                    self.cond.wait(self.max_age if not self.visits else
+                            max(0, self.oldest + self.max_age - time.time()))
+                if self.closed and not self.visits:
+                    break
+                batch = self.visits[:self.batch]
+                self.visits = self.visits[self.batch:]
+                self.oldest = time.time() if self.visits else None
+                contention = self.stats['contention']
+            self._write(batch)
+            # adaptive throttling: back off while writes hit contention
+            if self.stats['contention'] > contention:
+                self.delay = min(max(2 * self.delay, 0.1), BW_MAX_DELAY)
+            else:
+                self.delay = self.delay / 2 if self.delay > 0.01 else 0.0
+            if self.delay and not self.closed:
+                time.sleep(self.delay)
+
+    def _write(self, batch):
+        'write batch of visits with a (new) BulkWriter, waiting for it'
+        # a closed/flushed BulkWriter won't send fewer than 20 more writes
+        writer = fs_client.bulk_writer(
+                BulkWriterOptions(retry=BulkRetry.exponential))
+        writer.on_write_result(self._on_result)
+        writer.on_write_error(self._on_error)
+        with self.cond:
+            settled = self.stats['written'] + self.stats['failed']
+        try:
+            visits_ref = fs_client.collection('Visit')
+            for visit in batch:
+                writer.create(visits_ref.document(), visit)
+            writer.close()
+        except Exception:
+            logging.exception('bulk write of %d visit(s) failed', len(batch))
+        with self.cond:     # count visits neither written nor failed
+            unsent = len(batch) - (self.stats['written'] +
+                    self.stats['failed'] - settled)
+            if unsent > 0:
+                self.stats['dropped'] += unsent
+
+VISITS = VisitWriter(BW_MAX_SIZE, BW_BATCH, BW_MAX_AGE) if BULK_WRITES else None
+
 def store_visit(remote_addr, user_agent):
-    'create new Visit entity in Firestore'
+    'create new Visit entity in Firestore (or buffer it for bulk writing)'
     doc_ref = fs_client.collection('Visit')
-    doc_ref.add({
+    visit = {
         'timestamp': datetime.now(),
         'visitor': '{}: {}'.format(remote_addr, user_agent),
-    })
+    }
+    if SCATTER:
+        visit['shard'] = random.randrange(SCATTER)
+    if VISITS:
+        VISITS.add(visit)
+        return visit
+    doc_ref.add(visit)
+    return visit
+
+def _fetch_shard(shard, limit):
+    'get most recent visits of one scatter shard'
+    visits_ref = fs_client.collection('Visit').where('shard', '==', shard)
+    return [v.to_dict() for v in visits_ref.order_by('timestamp',
+            direction=firestore.Query.DESCENDING).limit(limit).stream()]
 
 def fetch_visits(limit):
-    'get most recent visits'
-    visits_ref = fs_client.collection('Visit')
-    visits = (v.to_dict() for v in visits_ref.order_by('timestamp',
-            direction=firestore.Query.DESCENDING).limit(limit).stream())
+    'get most recent visits (including any not yet written)'
+    if SCATTER:     # query shards concurrently, then merge newest
+        shards = _scatter_pool.map(_fetch_shard, range(SCATTER),
+                [limit] * SCATTER)
+        visits = itertools.islice(heapq.merge(*shards,
+                key=lambda v: v['timestamp'], reverse=True), limit)
+    else:
+        visits_ref = fs_client.collection('Visit')
+        visits = (v.to_dict() for v in visits_ref.order_by('timestamp',
+                direction=firestore.Query.DESCENDING).limit(limit).stream())
+    if VISITS:
+        return (VISITS.recent() + list(visits))[:limit]
     return visits
 
+def store_and_fetch(remote_addr, user_agent, limit):
+    'store new visit while fetching most recent ones, merging it in'
+    stored = _store_pool.submit(store_visit, remote_addr, user_agent)
+    visits = list(fetch_visits(limit))
+    visit = stored.result()
+    # fetch may or may not have seen it; (naive) timestamps are stored as UTC
+    ident = (visit['visitor'], visit['timestamp'])
+    return [visit] + [v for v in visits if (v['visitor'],
+            v['timestamp'].replace(tzinfo=None)) != ident][:limit-1]
+
 @app.route('/')
 def root():
     'main application (GET) handler'
+    if CONCURRENT and not VISITS:   # (bulk writes don't wait on writes)
+        visits = store_and_fetch(request.remote_addr, request.user_agent, 10)
+        return render_template('index.html', visits=visits)
     store_visit(request.remote_addr, request.user_agent)
     visits = fetch_visits(10)
     return render_template('index.html', visits=visits)
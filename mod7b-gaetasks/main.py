@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from datetime import datetime
+import hashlib
 import logging
 import time
 from flask import Flask, render_template, request
@@ -21,6 +22,11 @@ from google.appengine.ext import ndb
 
 app = Flask(__name__)
 app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
+TRIM_WINDOW = 60    # secs; at most one /trim task per window
+_trim_bucket = None # last window this instance saw a trim task for
+TRIM_BATCH = 100    # keys per delete batch...
+TRIM_INFLIGHT = 4   # ...& batches in flight at once (so page size is 400)
+TRIM_BUDGET = 30    # secs per /trim request before continuing in a new task
 
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
@@ -31,30 +37,59 @@ def store_visit(remote_addr, user_agent):
     'create new Visit entity in Datastore'
     Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
 
+def _trim_task_name(bucket):
+    'deterministic (but well-distributed) task name for trim time window'
+    return 'trim-%s-%d' % (
+            hashlib.md5(str(bucket).encode('utf-8')).hexdigest()[:8], bucket)
+
+def schedule_trim(oldest):
+    'add (named) task to delete older visits, at most once per time window'
+    global _trim_bucket
+    bucket = int(time.time() // TRIM_WINDOW)
+    if bucket == _trim_bucket:
+        return
+    try:
+        taskqueue.add(name=_trim_task_name(bucket), url='/trim',
+                params={'oldest': oldest})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass    # another instance already added this window's task
+    _trim_bucket = bucket
+
 def fetch_visits(limit):
     'get most recent visits & add task to delete older visits'
     data = Visit.query().order(-Visit.timestamp).fetch(limit)
     oldest = time.mktime(data[-1].timestamp.timetuple())
     oldest_str = time.ctime(oldest)
     logging.info('Delete entities older than %s' % oldest_str)
-    taskqueue.add(url='/trim', params={'oldest': oldest})
+    schedule_trim(oldest)
     return data, oldest_str
 
 @app.route('/trim', methods=['POST'])
 def trim():
-    '(push) task queue handler to delete oldest visits'
+    '(push) task queue handler to delete oldest visits, a page at a time'
     oldest = request.form.get('oldest', type=float)
-    keys = Visit.query(
-            Visit.timestamp < datetime.fromtimestamp(oldest)
-    ).fetch(keys_only=True)
-    nkeys = len(keys)
-    if nkeys:
-        logging.info('Deleting %d entities: %s' % (
-                nkeys, ', '.join(str(k.id()) for k in keys)))
-        ndb.delete_multi(keys)
-    else:
-        logging.info(
-                'No entities older than: %s' % time.ctime(oldest))
+    cursor = request.form.get('cursor')
+    cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    query = Visit.query(Visit.timestamp < datetime.fromtimestamp(oldest))
+    deadline = time.time() + TRIM_BUDGET
+    nkeys, more = 0, True
+    while more and time.time() < deadline:
+        keys, cursor, more = query.fetch_page(TRIM_BATCH * TRIM_INFLIGHT,
+                start_cursor=cursor, keys_only=True)
+        # delete page in TRIM_BATCH-sized batches, all in flight at once
+        futures = []
+        for i in range(0, len(keys), TRIM_BATCH):
+            futures.extend(ndb.delete_multi_async(keys[i:i+TRIM_BATCH]))
+        for future in futures:
+            future.check_success()
+        nkeys += len(keys)
+
+    # out of time: continue where we left off in a new task
+    if more and cursor:
+        taskqueue.add(url='/trim', params={
+                'oldest': oldest, 'cursor': cursor.urlsafe()})
+    logging.info('Deleted %d entities older than %s%s' % (nkeys,
+            time.ctime(oldest), ' (continuing)' if more else ''))
     return ''   # need to return SOME string w/200
 
 @app.route('/')
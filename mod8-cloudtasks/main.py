@@ -13,11 +13,13 @@
 # limitations under the License.
 
 from datetime import datetime
+import hashlib
 import json
 import logging
 import time
 from flask import Flask, render_template, request
 import google.auth
+from google.api_core import exceptions
 from google.cloud import ndb, tasks
 
 app = Flask(__name__)
@@ -28,6 +30,11 @@ _, PROJECT_ID = google.auth.default()
 REGION_ID = 'REGION_ID'    # replace w/your own
 QUEUE_NAME = 'default'     # replace w/your own
 QUEUE_PATH = ts_client.queue_path(PROJECT_ID, REGION_ID, QUEUE_NAME)
+TRIM_WINDOW = 60    # secs; at most one /trim task per window
+_trim_bucket = None # last window this instance saw a trim task for
+TRIM_BATCH = 100    # keys per delete batch...
+TRIM_INFLIGHT = 4   # ...& batches in flight at once (so page size is 400)
+TRIM_BUDGET = 30    # secs per /trim request before continuing in a new task
 
 class Visit(ndb.Model):
     'Visit entity registers visitor IP address & timestamp'
@@ -39,41 +46,78 @@ def store_visit(remote_addr, user_agent):
     with ds_client.context():
         Visit(visitor='{}: {}'.format(remote_addr, user_agent)).put()
 
-def fetch_visits(limit):
-    'get most recent visits & add task to delete older visits'
-    with ds_client.context():
-        data = Visit.query().order(-Visit.timestamp).fetch(limit)
-    oldest = time.mktime(data[-1].timestamp.timetuple())
-    oldest_str = time.ctime(oldest)
-    logging.info('Delete entities older than %s' % oldest_str)
+def _trim_task_name(bucket):
+    'deterministic (but well-distributed) task name for trim time window'
+    return 'trim-%s-%d' % (
+            hashlib.md5(str(bucket).encode('utf-8')).hexdigest()[:8], bucket)
+
+def _trim_task(payload, name=None):
+    '(push) task calling /trim with JSON payload (& optional task name)'
     task = {
         'app_engine_http_request': {
             'relative_uri': '/trim',
-            'body': json.dumps({'oldest': oldest}).encode(),
+            'body': json.dumps(payload).encode(),
             'headers': {
                 'Content-Type': 'application/json',
             },
         }
     }
-    ts_client.create_task(parent=QUEUE_PATH, task=task)
+    if name:
+        task['name'] = ts_client.task_path(
+                PROJECT_ID, REGION_ID, QUEUE_NAME, name)
+    return task
+
+def schedule_trim(oldest):
+    'create (named) task to delete older visits, at most once per time window'
+    global _trim_bucket
+    bucket = int(time.time() // TRIM_WINDOW)
+    if bucket == _trim_bucket:
+        return
+    task = _trim_task({'oldest': oldest}, _trim_task_name(bucket))
+    try:
+        ts_client.create_task(parent=QUEUE_PATH, task=task)
+    except exceptions.AlreadyExists:
+        pass    # another instance already created this window's task
+    _trim_bucket = bucket
+
+def fetch_visits(limit):
+    'get most recent visits & add task to delete older visits'
+    with ds_client.context():
+        data = Visit.query().order(-Visit.timestamp).fetch(limit)
+    oldest = time.mktime(data[-1].timestamp.timetuple())
+    oldest_str = time.ctime(oldest)
+    logging.info('Delete entities older than %s' % oldest_str)
+    schedule_trim(oldest)
     return data, oldest_str
 
 @app.route('/trim', methods=['POST'])
 def trim():
-    '(push) task queue handler to delete oldest visits'
-    oldest = float(request.get_json().get('oldest'))
+    '(push) task queue handler to delete oldest visits, a page at a time'
+    data = request.get_json()
+    oldest = float(data.get('oldest'))
+    cursor = data.get('cursor')
+    cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    deadline = time.time() + TRIM_BUDGET
+    nkeys, more = 0, True
     with ds_client.context():
-        keys = Visit.query(
-                Visit.timestamp < datetime.fromtimestamp(oldest)
-        ).fetch(keys_only=True)
-        nkeys = len(keys)
-        if nkeys:
-            logging.info('Deleting %d entities: %s' % (
-                    nkeys, ', '.join(str(k.id()) for k in keys)))
-            ndb.delete_multi(keys)
-        else:
-            logging.info(
-                    'No entities older than: %s' % time.ctime(oldest))
+        query = Visit.query(Visit.timestamp < datetime.fromtimestamp(oldest))
+        while more and time.time() < deadline:
+            keys, cursor, more = query.fetch_page(TRIM_BATCH * TRIM_INFLIGHT,
+                    start_cursor=cursor, keys_only=True)
+            # delete page in TRIM_BATCH-sized batches, all in flight at once
+            futures = []
+            for i in range(0, len(keys), TRIM_BATCH):
+                futures.extend(ndb.delete_multi_async(keys[i:i+TRIM_BATCH]))
+            for future in futures:
+                future.check_success()
+            nkeys += len(keys)
+
+    # out of time: continue where we left off in a new task
+    if more and cursor:
+        ts_client.create_task(parent=QUEUE_PATH, task=_trim_task({
+                'oldest': oldest, 'cursor': cursor.urlsafe().decode('utf-8')}))
+    logging.info('Deleted %d entities older than %s%s' % (nkeys,
+            time.ctime(oldest), ' (continuing)' if more else ''))
     return ''   # need to return SOME string w/200
 
 @app.route('/')
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import json
 import time
 from flask import Flask, render_template, request
 import google.auth
+from google.api_core import exceptions
 from google.cloud import datastore, tasks
 
 app = Flask(__name__)
@@ -28,6 +31,13 @@ REGION_ID = 'REGION_ID'    # replace w/your own
 QUEUE_NAME = 'default'     # replace w/your own
 QUEUE_PATH = ts_client.queue_path(PROJECT_ID, REGION_ID, QUEUE_NAME)
 PATH_PREFIX = QUEUE_PATH.rsplit('/', 2)[0]
+TRIM_WINDOW = 60    # secs; at most one /trim task per window
+_trim_bucket = None # last window this instance saw a trim task for
+TRIM_BATCH = 100    # keys per delete batch...
+TRIM_INFLIGHT = 4   # ...& batches in flight at once (so page size is 400)
+TRIM_BUDGET = 30    # secs per /trim request before continuing in a new task
+_trim_pool = ThreadPoolExecutor(TRIM_INFLIGHT)
+_queue_ok = False   # whether queue is known to exist (checked once)
 
 def store_visit(remote_addr, user_agent):
     'create new Visit entity in Datastore'
@@ -40,50 +50,103 @@ def store_visit(remote_addr, user_agent):
 
 def _create_queue_if():
     'app-internal function creating default queue if it does not exist'
+    global _queue_ok
+    if not _queue_ok:   # only check once per process
+        try:
+            ts_client.get_queue(name=QUEUE_PATH)
+        except exceptions.NotFound:
+            try:
+                ts_client.create_queue(parent=PATH_PREFIX,
+                        queue={'name': QUEUE_PATH})
+            except exceptions.AlreadyExists:
+                pass    # another instance just created it
+        _queue_ok = True
+
+def _create_task(task):
+    'create task, (re-)creating queue if it does not exist'
+    global _queue_ok
+    _create_queue_if()
     try:
-        ts_client.get_queue(name=QUEUE_PATH)
-    except Exception as e:
-        if 'does not exist' in str(e):
-            ts_client.create_queue(parent=PATH_PREFIX,
-                    queue={'name': QUEUE_PATH})
-    return True
+        ts_client.create_task(parent=QUEUE_PATH, task=task)
+    except exceptions.NotFound:     # queue deleted since we checked
+        _queue_ok = False
+        _create_queue_if()
+        ts_client.create_task(parent=QUEUE_PATH, task=task)
 
-def fetch_visits(limit):
-    'get most recent visits & add task to delete older visits'
-    query = ds_client.query(kind='Visit')
-    query.order = ['-timestamp']
-    visits = list(query.fetch(limit=limit))
-    oldest = time.mktime(visits[-1]['timestamp'].timetuple())
-    oldest_str = time.ctime(oldest)
-    print('Delete entities older than %s' % oldest_str)
+def _trim_task_name(bucket):
+    'deterministic (but well-distributed) task name for trim time window'
+    return 'trim-%s-%d' % (
+            hashlib.md5(str(bucket).encode('utf-8')).hexdigest()[:8], bucket)
+
+def _trim_task(payload, name=None):
+    '(push) task calling /trim with JSON payload (& optional task name)'
     task = {
         'app_engine_http_request': {
             'relative_uri': '/trim',
-            'body': json.dumps({'oldest': oldest}).encode(),
+            'body': json.dumps(payload).encode(),
             'headers': {
                 'Content-Type': 'application/json',
             },
         }
     }
-    if _create_queue_if():
-        ts_client.create_task(parent=QUEUE_PATH, task=task)
+    if name:
+        task['name'] = ts_client.task_path(
+                PROJECT_ID, REGION_ID, QUEUE_NAME, name)
+    return task
+
+def schedule_trim(oldest):
+    'create (named) task to delete older visits, at most once per time window'
+    global _trim_bucket
+    bucket = int(time.time() // TRIM_WINDOW)
+    if bucket == _trim_bucket:
+        return
+    task = _trim_task({'oldest': oldest}, _trim_task_name(bucket))
+    try:
+        _create_task(task)
+    except exceptions.AlreadyExists:
+        pass    # another instance already created this window's task
+    _trim_bucket = bucket
+
+def fetch_visits(limit):
+    'get most recent visits & add task to delete older visits'
+    query = ds_client.query(kind='Visit')
+    query.order = ['-timestamp']
+    visits = list(query.fetch(limit=limit))
+    oldest = time.mktime(visits[-1]['timestamp'].timetuple())
+    oldest_str = time.ctime(oldest)
+    print('Delete entities older than %s' % oldest_str)
+    schedule_trim(oldest)
     return visits, oldest_str
 
 @app.route('/trim', methods=['POST'])
 def trim():
-    '(push) task queue handler to delete oldest visits'
-    oldest = float(request.get_json().get('oldest'))
+    '(push) task queue handler to delete oldest visits, a page at a time'
+    data = request.get_json()
+    oldest = float(data.get('oldest'))
+    cursor = data.get('cursor')
     query = ds_client.query(kind='Visit')
     query.add_filter('timestamp', '<', datetime.fromtimestamp(oldest))
     query.keys_only()
-    keys = list(visit.key for visit in query.fetch())
-    nkeys = len(keys)
-    if nkeys:
-        print('Deleting %d entities: %s' % (
-                nkeys, ', '.join(str(k.id) for k in keys)))
-        ds_client.delete_multi(keys)
-    else:
-        print('No entities older than: %s' % time.ctime(oldest))
+    deadline = time.time() + TRIM_BUDGET
+    nkeys, more = 0, True
+    while more and time.time() < deadline:
+        visits = query.fetch(limit=TRIM_BATCH * TRIM_INFLIGHT,
+                start_cursor=cursor)
+        keys = [visit.key for visit in next(visits.pages, [])]
+        # delete page in TRIM_BATCH-sized batches, all in flight at once
+        list(_trim_pool.map(ds_client.delete_multi,
+                [keys[i:i+TRIM_BATCH] for i in range(0, len(keys), TRIM_BATCH)]))
+        nkeys += len(keys)
+        cursor = visits.next_page_token
+        more = bool(keys and cursor)
+
+    # out of time: continue where we left off in a new task
+    if more:
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode('utf-8')
+        _create_task(_trim_task({'oldest': oldest, 'cursor': cursor}))
+    print('Deleted %d entities older than %s%s' % (nkeys,
+            time.ctime(oldest), ' (continuing)' if more else ''))
     return ''   # need to return SOME string w/200
 
 @app.route('/')